@@ -0,0 +1,78 @@
+"""Measure a chain of async commands talking to a local server.
+
+    python benchmarks/async_chain.py
+
+Each command sends a request to a local stand-in server. With one event loop
+for the whole run, the connection opened by the first command is reused by
+the following ones; the "connect" column opens a connection per command, as
+needed when each command runs in its own loop.
+"""
+
+import asyncio
+import threading
+import timeit
+
+from minicli import cli, run, wrap
+
+CHAIN_LENGTHS = (1, 10, 100)
+connection = {}
+
+
+async def handle(reader, writer):
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        writer.write(line)
+        await writer.drain()
+    writer.close()
+
+
+def start_server():
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(handle, "127.0.0.1", 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server.sockets[0].getsockname()[1]
+
+
+async def request(reader, writer):
+    writer.write(b"ping\n")
+    await writer.drain()
+    assert await reader.readline() == b"ping\n"
+
+
+def main():
+    port = start_server()
+
+    @wrap
+    async def pool():
+        yield
+        if connection:
+            connection["writer"].close()
+            connection.clear()
+
+    @cli
+    async def pooled():
+        if not connection:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            connection.update(reader=reader, writer=writer)
+        await request(connection["reader"], connection["writer"])
+
+    @cli
+    async def connect():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await request(reader, writer)
+        writer.close()
+
+    print(f"{'chain':>6} {'pooled (ms)':>12} {'connect (ms)':>13}")
+    for length in CHAIN_LENGTHS:
+        timings = []
+        for name in ("pooled", "connect"):
+            timer = timeit.Timer(lambda: run(*[name] * length))
+            number, _ = timer.autorange()
+            timings.append(min(timer.repeat(repeat=5, number=number)) / number)
+        print(f"{length:>6} {timings[0] * 1000:>12.3f} {timings[1] * 1000:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Measure the per-call cost of binding parsed values to a command.
+
+    python benchmarks/binding.py
+
+Compares the precompiled binding plan (Cli.bind, prepare_wrappers) with
+walking the inspect signature at each call, as done before.
+"""
+
+import argparse
+import inspect
+import timeit
+
+from minicli import NO_DEFAULT, _wrapper_functions, cli, wrap
+from minicli import prepare_wrappers
+
+PARAMETERS = (1, 10, 50)
+
+
+def make_function(parameters, generator=False):
+    params = ["p0"] + [f"p{index}=None" for index in range(1, parameters)]
+    body = "yield" if generator else "pass"
+    namespace = {}
+    exec(f"def function({', '.join(params)}):\n    {body}\n", namespace)
+    return namespace["function"]
+
+
+def bind_from_signature(func, values):
+    args, kwargs = [], {}
+    for name, parameter in inspect.signature(func).parameters.items():
+        value = values.get(name)
+        if parameter.kind == parameter.VAR_POSITIONAL:
+            args.extend(value)
+        elif parameter.default == NO_DEFAULT:
+            args.append(value)
+        else:
+            kwargs[name] = value
+    return args, kwargs
+
+
+def per_call(func):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e6
+
+
+def main():
+    print(
+        f"{'params':>6} {'signature (µs)':>15} {'plan (µs)':>10} {'wrapper (µs)':>13}"
+    )
+    for parameters in PARAMETERS:
+        command = cli(make_function(parameters))
+        parsed = argparse.Namespace(**{f"p{i}": i for i in range(parameters)})
+        values = vars(parsed)
+        _wrapper_functions.clear()
+        wrap(make_function(parameters, generator=True))
+        shared = dict(values)
+
+        print(
+            f"{parameters:>6}"
+            f" {per_call(lambda: bind_from_signature(command, values)):>15.2f}"
+            f" {per_call(lambda: command._cli.bind(parsed)):>10.2f}"
+            f" {per_call(lambda: prepare_wrappers(**shared)):>13.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Measure running a command over many values.
+
+    python benchmarks/fanout.py
+
+Compares a shell-like loop starting one process per value with a single
+run fanning the values out over a process pool (--minicli-jobs defaults to
+the number of CPUs).
+"""
+
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SOURCE = """\
+import hashlib
+from minicli import cli, run
+
+@cli("path", fanout="process")
+def checksum(path):
+    return hashlib.sha256(path.encode() * 1000).hexdigest()[:8]
+
+run()
+"""
+
+
+def timed(*argv, **kwargs):
+    start = time.perf_counter()
+    subprocess.run(argv, stdout=subprocess.DEVNULL, check=True, **kwargs)
+    return time.perf_counter() - start
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        script = Path(directory) / "script.py"
+        script.write_text(SOURCE)
+        values = Path(directory) / "values"
+        print(f"{'values':>7} {'loop (s)':>9} {'fanout (s)':>11}")
+        for count in (50, 5000, 50000):
+            values.write_text("".join(f"file-{index}\n" for index in range(count)))
+            loop = ""
+            if count <= 50:
+                loop = sum(
+                    timed(sys.executable, str(script), "checksum", f"file-{index}")
+                    for index in range(count)
+                )
+                loop = f"{loop:.3f}"
+            fanout = timed(sys.executable, str(script), "checksum", f"@{values}")
+            print(f"{count:>7} {loop:>9} {fanout:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""Measure `run()` parse time while the registry grows.
+
+    python benchmarks/lazy_parsers.py
+
+Only the invoked command parser is built, so the time to dispatch a single
+command should stay flat whatever the registry size.
+"""
+
+import timeit
+
+from minicli import _registry, cli, run
+
+SIZES = (10, 100, 1000, 5000)
+
+
+def make_command(index):
+    namespace = {}
+    exec(
+        f"def command_{index}(param, option=1, flag=False):\n"
+        f'    """Command {index}.\n\n    :param: some param\n    """\n',
+        namespace,
+    )
+    return namespace[f"command_{index}"]
+
+
+def main():
+    print(f"{'commands':>10} {'run() in ms':>12}")
+    for size in SIZES:
+        _registry.clear()
+        for index in range(size):
+            cli(make_command(index))
+        timer = timeit.Timer(lambda: run("command-0", "value", "--option", "2"))
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat=5, number=number)) / number
+        print(f"{size:>10} {best * 1000:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
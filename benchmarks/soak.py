@@ -0,0 +1,59 @@
+"""Run the same app many times in one process, and check memory stays flat.
+
+    python benchmarks/soak.py [calls]
+
+Reports the time per call and the memory traced by tracemalloc, every tenth
+of the calls, with a sync and an async wrapper around a sync and an async
+command.
+"""
+
+import sys
+import time
+import tracemalloc
+
+from minicli import App
+
+CALLS = 100_000
+
+
+def make_app():
+    app = App()
+
+    @app.cli
+    def mycommand(param, count: int = 1):
+        pass
+
+    @app.cli
+    async def myasynccommand(param):
+        pass
+
+    @app.wrap
+    def my_wrapper(hostname):
+        yield
+
+    @app.wrap
+    async def my_async_wrapper():
+        yield
+
+    return app
+
+
+def main(calls=CALLS):
+    app = make_app()
+    argv = ["--hostname", "example.com", "mycommand", "foo", "--count", "2"]
+    argv += ["myasynccommand", "bar"]
+    step = max(1, calls // 10)
+    tracemalloc.start()
+    print(f"{'calls':>8} {'µs/call':>8} {'traced (KiB)':>13}")
+    start = time.perf_counter()
+    for call in range(1, calls + 1):
+        app.run(*argv, hostname="localhost")
+        if call % step == 0:
+            elapsed = (time.perf_counter() - start) / step * 1e6
+            traced = tracemalloc.get_traced_memory()[0] / 1024
+            print(f"{call:>8} {elapsed:>8.1f} {traced:>13.1f}")
+            start = time.perf_counter()
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
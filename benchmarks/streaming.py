@@ -0,0 +1,56 @@
+"""Measure writing many rows from a command.
+
+    python benchmarks/streaming.py
+
+Compares a command printing each row with a generator command streamed by
+minicli, in each output format, stdout being /dev/null.
+"""
+
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROWS = 1_000_000
+SOURCE = """\
+from minicli import cli, run
+
+@cli
+def printed(rows: int):
+    for index in range(rows):
+        print({"id": index, "name": "row"})
+
+@cli
+def streamed(rows: int):
+    for index in range(rows):
+        yield {"id": index, "name": "row"}
+
+run()
+"""
+SCENARIOS = [
+    ("print", ["printed"]),
+    ("lines", ["streamed"]),
+    ("jsonl", ["--minicli-format", "jsonl", "streamed"]),
+    ("csv", ["--minicli-format", "csv", "streamed"]),
+    ("nul", ["--minicli-format", "nul", "streamed"]),
+]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        script = Path(directory) / "script.py"
+        script.write_text(SOURCE)
+        print(f"{'scenario':<8} {'seconds':>8}")
+        for name, argv in SCENARIOS:
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, str(script), *argv, str(ROWS)],
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            print(f"{name:<8} {time.perf_counter() - start:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Benchmark suite for parsing, dispatch and chaining at scale.
+
+    python benchmarks/suite.py             # Compare with baseline.json.
+    python benchmarks/suite.py --update    # Store the results as baseline.
+
+Synthetic registries (10 to 5000 commands, 1 to 50 parameters, a mix of sync
+and async commands and wrappers) are generated, then cold start, help
+rendering, single dispatch, long chains and repeated in-process run() calls
+are measured, dispatch and chains also with the fast parser. Exits with
+status 1 when a scenario is slower than the baseline by more than the
+threshold.
+
+Timings depend on the machine: store a baseline (from the main branch) on
+the machine running the comparison.
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import minicli
+
+BASELINE = Path(__file__).parent / "baseline.json"
+# (commands, parameters) of each generated registry.
+REGISTRIES = [(10, 5), (500, 10), (5000, 1), (100, 50)]
+
+
+def make_source(commands, parameters, wrappers=2):
+    lines = ["from minicli import cli, wrap", ""]
+    for index in range(commands):
+        params = []
+        doc = [f"Command {index}.", ""]
+        for position in range(parameters):
+            name = f"p{position}"
+            if position < 2:
+                params.append(f"{name}: int" if position else name)
+            elif position % 3 == 0:
+                params.append(f"{name}=1")
+            elif position % 3 == 1:
+                params.append(f"{name}=False")
+            else:
+                params.append(f"{name}=[]")
+            doc.append(f":{name}: help of parameter {name}")
+        prefix = "async " if index % 2 else ""
+        lines += [
+            "@cli",
+            f"{prefix}def command_{index}({', '.join(params)}):",
+            f'    """{chr(10).join(doc)}"""',
+            "",
+        ]
+    for index in range(wrappers):
+        prefix = "async " if index % 2 else ""
+        lines += ["@wrap", f"{prefix}def wrapper_{index}():", "    yield", ""]
+    return "\n".join(lines)
+
+
+def command_argv(index, parameters):
+    argv = [f"command-{index}"]
+    for position in range(parameters):
+        if position < 2:
+            argv.append("1")
+        elif position % 3 == 0:
+            argv += [f"--p{position}", "2"]
+        elif position % 3 == 1:
+            argv.append(f"--p{position}")
+        else:
+            argv += [f"--p{position}", "a", f"--p{position}", "b"]
+    return argv
+
+
+def reset():
+    minicli._registry.clear()
+    minicli._wrapper_functions.clear()
+
+
+def best(func, repeat=3, budget=0.1):
+    """Return the best time of `func`, run as many times as fit in `budget`."""
+    start = time.perf_counter()
+    func()
+    number = max(1, int(budget / max(time.perf_counter() - start, 1e-6)))
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return min(timings)
+
+
+def quiet(func):
+    def wrapper():
+        with contextlib.redirect_stdout(io.StringIO()):
+            with contextlib.suppress(SystemExit):
+                func()
+
+    return wrapper
+
+
+def measure(directory, commands, parameters):
+    module = f"registry_{commands}_{parameters}"
+    (directory / f"{module}.py").write_text(make_source(commands, parameters))
+    argv = command_argv(0, parameters)
+    code = f"import {module}; from minicli import run; run(*{argv!r})"
+    cold = best(
+        lambda: subprocess.run([sys.executable, "-c", code], cwd=directory, check=True),
+        repeat=3,
+        budget=0,
+    )
+    reset()
+    importlib.import_module(module)
+    chain = [
+        arg
+        for index in range(min(commands, 100))
+        for arg in command_argv(index, parameters)
+    ]
+    results = {
+        "cold_start": cold,
+        "help": best(quiet(lambda: minicli.run("--help"))),
+        "dispatch": best(quiet(lambda: minicli.run(*argv))),
+        "chain": best(quiet(lambda: minicli.run(*chain))),
+        "repeated": best(quiet(lambda: [minicli.run(*argv) for _ in range(20)])),
+    }
+    minicli.configure(parser="fast")
+    results["fast_dispatch"] = best(quiet(lambda: minicli.run(*argv)))
+    results["fast_chain"] = best(quiet(lambda: minicli.run(*chain)))
+    minicli.configure(parser="argparse")
+    reset()
+    return {f"{commands}x{parameters}:{name}": value for name, value in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--update", action="store_true", help="Store as baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=2,
+        help="Slowdown ratio making the suite fail (default: 2)",
+    )
+    options = parser.parse_args()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        sys.path.insert(0, directory)
+        for commands, parameters in REGISTRIES:
+            results.update(measure(Path(directory), commands, parameters))
+    baseline = json.loads(BASELINE.read_text()) if BASELINE.exists() else {}
+    failures = []
+    print(f"{'scenario':<24} {'ms':>10} {'baseline':>10} {'ratio':>6}")
+    for name, value in results.items():
+        reference = baseline.get(name)
+        ratio = value / reference if reference else None
+        print(
+            f"{name:<24} {value * 1000:>10.3f} "
+            + (f"{reference * 1000:>10.3f} {ratio:>6.2f}" if reference else "")
+        )
+        if ratio and ratio > options.threshold:
+            failures.append(name)
+    if options.update:
+        BASELINE.write_text(json.dumps(results, indent=2, sort_keys=True) + "\n")
+    elif failures:
+        sys.exit(f"Slower than baseline: {', '.join(failures)}")
+
+
+if __name__ == "__main__":
+    main()
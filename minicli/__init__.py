@@ -1,95 +1,302 @@
-import argparse
-import asyncio
+# Modules slow to import (argparse, asyncio, json…) are imported where they
+# are needed, so importing minicli and registering commands stays cheap.
+import collections
+import contextlib
+import contextvars
+import functools
+import importlib
 import inspect
+import os
+import re
 import sys
-import typing
+import threading
+import types
 import warnings
 
 NO_DEFAULT = inspect._empty
 NARGS = ...
-_wrapper_functions = []
-_wrapper_generators = []
-_registry = []
+# Binding plan slots, see compile_plan.
+ARG, VARARGS, KWARG = range(3)
+PARAMETER_HELP = re.compile(r":(\w+):(.*)")
+Docstring = collections.namedtuple("Docstring", ["summary", "params"])
+MANIFEST_VERSION = 1
+SETTINGS = {
+    # Path of the commands manifest, see load_manifest.
+    "manifest": None,
+    # Callable returning the event loop used by async commands and wrappers,
+    # uvloop when installed, asyncio default loop otherwise.
+    "loop_factory": None,
+    # Maximum number of chained commands run at the same time, see
+    # run_concurrently. Setting it enables the concurrent mode.
+    "concurrency": None,
+    # Command line parsing engine: "argparse", "fast" (lookup tables compiled
+    # from the commands signatures, see fast_parse) or "check" (both, and
+    # compare their results).
+    "parser": "argparse",
+    # Default format of the items yielded by generator commands, see Output.
+    "format": "lines",
+    # Directory of the commands output cache (XDG cache directory by
+    # default) and its maximum size in bytes, see minicli.cache.
+    "cache_dir": None,
+    "cache_size": 1 << 26,
+    # Callable given the runtime metrics of the commands and wrappers, by
+    # batches of records, see minicli.metrics.
+    "metrics": None,
+}
+# Options handled by minicli itself, hidden from the help, see
+# split_builtins. A global parameter with the same name takes precedence.
+BUILTIN_OPTIONS = {
+    "minicli_parallel": {"action": "store_true"},
+    "minicli_batch": {"metavar": "FILE"},
+    "minicli_batch_null": {"action": "store_true"},
+    "minicli_profile": {"nargs": "?", "const": "-", "metavar": "FILE"},
+    "minicli_profile_memory": {"action": "store_true"},
+    "minicli_profile_cprofile": {"metavar": "FILE"},
+    "minicli_format": {"choices": ["lines", "jsonl", "csv", "nul"]},
+    "minicli_jobs": {"type": int, "metavar": "N"},
+    "minicli_unordered": {"action": "store_true"},
+    "minicli_no_cache": {"action": "store_true"},
+}
+BUILTIN_FLAGS = {"--" + name.replace("_", "-") for name in BUILTIN_OPTIONS}
+# @cli kwargs handled by minicli, not given to add_parser.
+COMMAND_OPTIONS = ("cache", "requires", "inputs", "outputs")
+FANOUT_POOLS = ("process", "thread")
+FANOUT_CHUNK = 64
+# App being run, see current_app.
+_app_var = contextvars.ContextVar("minicli_app")
+# Event loop and Output of the current run: each thread, and each app.run
+# call, has its own.
+_loop = contextvars.ContextVar("minicli_loop", default=None)
+_output = contextvars.ContextVar("minicli_output", default=None)
+# Values yielded by the wrappers of the current run, by provided parameter.
+_resources = contextvars.ContextVar("minicli_resources", default={})
+_profiler = None
+_parsing = threading.local()
+# make_argument kwargs and actions understood by the fast parser.
+FAST_KWARGS = {"dest", "default", "type", "action", "help", "metavar", "choices"}
+FAST_ACTIONS = (None, "store", "store_true", "store_false", "append")
+LISTS = (list, type(None))
+# array.array typecodes of list[int] and list[float] parameters.
+ARRAY_TYPECODES = {(int,): "q", (float,): "d"}
+HELP_FLAGS = ("-h", "--help")
+NO_PROFILE = contextlib.nullcontext()
+
+
+class Uncacheable(Exception):
+    """Raised when a value cannot be stored in the manifest."""
 
 
 class Cli:
+    loaded = True
+    app = None  # Set by App.register.
+
     def __init__(self, command, **extra):
         self.extra = extra
         self.command = command
+        self.__name__ = command.__name__
+        self._names = None
         self.inspect()
         if not hasattr(command, "_cli"):
             command._cli = self
-            _registry.append(self)
 
     def __call__(self, *args, **kwargs):
         """Run original command."""
         try:
             res = self.command(*args, **kwargs)
             if self._async:
-                asyncio.get_event_loop().run_until_complete(res)
+                run_async(res)
+            elif inspect.isgenerator(res):
+                current_output().write_all(res)
+            elif inspect.isasyncgen(res):
+                run_async(current_output().write_async(res))
         except KeyboardInterrupt:
             pass
 
     def invoke(self, parsed, **shared):
         """Run command from command line args."""
-        kwargs = {}
-        args = []
-        for name, parameter in self.spec.parameters.items():
-            value = shared.get(name, getattr(parsed, name))
-            if parameter.kind == parameter.VAR_POSITIONAL:
-                args.extend(value)
-            elif parameter.default == NO_DEFAULT:
-                args.append(value)
-            else:
-                kwargs[name] = value
+        args, kwargs = self.bind(parsed, **shared)
         return self(*args, **kwargs)
 
+    def bind(self, parsed, **shared):
+        """Return command args and kwargs from command line args, and the
+        resources yielded by the wrappers."""
+        values = vars(parsed)
+        resources = _resources.get()
+        if shared or resources:
+            values = {**values, **shared, **resources}
+        streamed = self.streamed
+        if streamed:
+            values = dict(values)
+            for name, type_ in streamed:
+                if values.get(name) is not None:  # Else keep the None default.
+                    values[name] = stream_values(values[name], type_)
+        return bind(self.plan, values)
+
     @property
     def help(self):
         return self.command.__doc__ or ""
 
+    @property
+    def docstring(self):
+        if "_docstring" not in self.__dict__:  # Parsed once.
+            self._docstring = parse_docstring(self.help)
+        return self._docstring
+
     @property
     def short_help(self):
-        return self.help.split("\n\n")[0]
+        return self.docstring.summary
 
     def inspect(self):
+        with profile("inspect", command=self.__name__):
+            self._inspect()
+
+    def _inspect(self):
         self.__doc__ = inspect.getdoc(self.command)
         self.spec = inspect.signature(self.command)
+        self.plan = compile_plan(self.spec)
         self._async = inspect.iscoroutinefunction(self.command)
 
+    def option(self, name, default=None):
+        """Return the `name` option given to @cli, see COMMAND_OPTIONS."""
+        return self.extra.get("__self__", {}).get(name, default)
+
+    @property
+    def cache(self):
+        """Time to live in seconds of the cached output, True for no expiry,
+        None when not cached."""
+        return self.option("cache") or None
+
+    @property
+    def scheduled(self):
+        """Tell if this command declares requirements, inputs or outputs, see
+        run_graph."""
+        return any(self.option(name) for name in ("requires", "inputs", "outputs"))
+
+    def paths(self, name, values):
+        """Return the `name` ("inputs" or "outputs") paths, formatted with
+        the arguments `values`."""
+        return [str(path).format(**values) for path in self.option(name, ())]
+
+    @property
+    def streamed(self):
+        """Names and types of the parameters given as lazy iterators."""
+        return [
+            (name, self.value_type(name))
+            for name, kwargs in self.extra.items()
+            if kwargs.get("stream")
+        ]
+
+    def value_type(self, name):
+        """Return the type of each value of the `name` parameter, if any."""
+        type_ = self.extra[name].get("type", self.spec.parameters[name].annotation)
+        if getattr(type_, "__origin__", None) is list:
+            type_ = type_.__args__[0]  # list[int]…
+        if type_ in (NO_DEFAULT, list, tuple) or not callable(type_):
+            return None
+        return type_
+
+    @property
+    def fanout(self):
+        """Name and pool ("process" or "thread") of the fan-out parameter."""
+        for name, kwargs in self.extra.items():
+            if kwargs.get("fanout"):
+                return name, kwargs["fanout"]
+        return None
+
     def parse_parameter_help(self, name):
-        try:
-            return self.help.split(":{}:".format(name), 1)[1].split("\n")[0].strip()
-        except IndexError:
-            return ""
+        return self.docstring.params.get(name, "")
+
+    @property
+    def table(self):
+        if "_table" not in self.__dict__:  # Compiled once, see changed.
+            self._table = compile_table(self)
+        return self._table
+
+    def changed(self):
+        """Forget what was computed from the name and overrides."""
+        self._names = None
+        self.__dict__.pop("_table", None)
+        if self.app is not None:
+            self.app.version += 1  # Parsers must be built again.
 
     def create_name(self, kwargs):
-        name = self.command.__name__
+        name = self.__name__
         if "_" in name:
             kwargs["aliases"] = [name]
             name = name.replace("_", "-")
         kwargs["name"] = name
 
-    def init_parser(self, subparsers):
-        kwargs = {"help": self.short_help, "conflict_handler": "resolve"}
+    @property
+    def names(self):
+        """Command name and aliases, without building any parser."""
+        if self._names is None:
+            kwargs = {}
+            self.create_name(kwargs)
+            kwargs.update(self.extra.get("__self__", {}))
+            self._names = frozenset([kwargs["name"], *kwargs.get("aliases", [])])
+        return self._names
+
+    def init_parser(self, subparsers, full=True):
+        with profile("init_parser", command=self.__name__):
+            self._init_parser(subparsers, full)
+
+    def _init_parser(self, subparsers, full):
+        self.parser = subparsers.add_parser(**self.parser_kwargs())
+        self.set_defaults(func=self.invoke)
+        if full or self.loaded:
+            self.add_arguments()
+
+    def arguments(self):
+        """Return the parameters given on the command line, that is not the
+        ones provided by a wrapper: they receive its yielded value."""
+        resources = self.app.resources if self.app is not None else ()
+        return [
+            (name, parameter)
+            for name, parameter in self.spec.parameters.items()
+            if name not in resources
+        ]
+
+    def add_arguments(self):
+        for arg_name, parameter in self.arguments():
+            self.add_argument(arg_name, **self.parameter_kwargs(arg_name, parameter))
+
+    def parser_kwargs(self):
+        """Return add_parser kwargs for this command."""
+        kwargs = {"conflict_handler": "resolve"}
         self.create_name(kwargs)
         kwargs.update(self.extra.get("__self__", {}))
-        self.parser = subparsers.add_parser(**kwargs)
-        self.set_defaults(func=self.invoke)
-        for arg_name, parameter in self.spec.parameters.items():
-            kwargs = {}
-            default = parameter.default
-            if parameter.kind == parameter.VAR_POSITIONAL:
-                default = NARGS
-            type_ = parameter.annotation
-            if type_ != inspect._empty:
-                kwargs["type"] = type_
-            kwargs.update(self.extra.get(arg_name, {}))
-            if "help" not in kwargs:
-                kwargs["help"] = self.parse_parameter_help(arg_name)
-            if "default" not in kwargs:
-                kwargs["default"] = default
-            self.add_argument(arg_name, **kwargs)
+        for name in COMMAND_OPTIONS:
+            kwargs.pop(name, None)
+        if "help" not in kwargs:
+            kwargs["help"] = self.short_help
+        return kwargs
+
+    def parameter_kwargs(self, arg_name, parameter):
+        """Return make_argument kwargs for this parameter."""
+        kwargs = {}
+        default = parameter.default
+        if parameter.kind == parameter.VAR_POSITIONAL:
+            default = NARGS
+        type_ = parameter.annotation
+        if type_ != inspect._empty:
+            kwargs["type"] = type_
+        kwargs.update(self.extra.get(arg_name, {}))
+        if kwargs.pop("fanout", None):
+            # Values are converted in the workers, once @file are read.
+            kwargs.pop("type", None)
+            kwargs["nargs"] = "+"
+        elif kwargs.pop("stream", None):
+            # Values are converted while iterated, once @file are read.
+            kwargs.pop("type", None)
+            if default is NO_DEFAULT:
+                kwargs["nargs"] = "+"
+            elif default is not NARGS:
+                kwargs["type"] = list  # Many --name options.
+        if "help" not in kwargs:
+            kwargs["help"] = self.parse_parameter_help(arg_name)
+        if "default" not in kwargs:
+            kwargs["default"] = default
+        return kwargs
 
     def add_argument(self, arg_name, **kwargs):
         args, kwargs = make_argument(arg_name, **kwargs)
@@ -99,74 +306,1983 @@ class Cli:
         self.parser.set_defaults(**kwargs)
 
 
-def cli(*args, **kwargs):
-    if not args:
-        # User-friendlyness: allow using @cli() without any argument.
-        if kwargs:  # Overriding parser arguments with only kwargs.
-            return lambda f: cli(f, "__self__", **kwargs)
-        return cli
-    if not callable(args[0]):
-        # We are overriding an argument from the decorator.
-        return lambda f: cli(f, *args, **kwargs)
-    func = args[0]
-    extra = {}
-    if hasattr(func, "_cli") and len(args) > 1 and kwargs:
-        # Chaining cli(xxx) calls.
-        extra = func._cli.extra
-    if len(args) > 1:
-        extra[args[1]] = kwargs
-    Cli(func, **extra)
-    return func
-
-
-def run(*input, **shared):
-    if len(input) and callable(input[0]):
-        _run_single(*input, **shared)
+def parse_docstring(doc):
+    """Return the summary and the parameters help of `doc`, in one pass.
+
+    The summary is the first paragraph, parameters help are given by
+    `:name: help` lines, and continue on the following lines until an empty
+    line or another parameter.
+    """
+    summary = []
+    params = {}
+    current = None
+    in_summary = True
+    for line in inspect.cleandoc(doc).splitlines():
+        line = line.strip()
+        match = PARAMETER_HELP.match(line)
+        if match:
+            in_summary = False
+            current = params[match.group(1)] = [match.group(2).strip()]
+        elif not line:
+            in_summary = False
+            current = None
+        elif current is not None:
+            current.append(line)
+        elif in_summary:
+            summary.append(line)
+    params = {name: " ".join(help) for name, help in params.items()}
+    return Docstring("\n".join(summary), params)
+
+
+class LazyCli(Cli):
+    """Command registered by import path, imported only when needed."""
+
+    def __init__(self, path, **extra):
+        self.extra = extra
+        self.path = path
+        self.__name__ = path.rsplit(":", 1)[-1].rsplit(".", 1)[-1]
+        self._names = None
+
+    def __getattr__(self, name):
+        if name == "spec" and "_parameters" in self.__dict__:
+            # Restored from the manifest: types are only resolved now.
+            self.spec = inspect.Signature(
+                [
+                    inspect.Parameter(
+                        param_name,
+                        inspect._ParameterKind(kind),
+                        default=decode(default),
+                        annotation=decode(annotation),
+                    )
+                    for param_name, kind, default, annotation in self._parameters
+                ]
+            )
+            return self.spec
+        if name == "plan" and "_parameters" in self.__dict__:
+            self.plan = compile_plan(self.spec)
+            return self.plan
+        if name in ("command", "spec", "plan", "_async"):
+            self.load()
+            return getattr(self, name)
+        raise AttributeError(name)
+
+    @property
+    def loaded(self):
+        return "command" in self.__dict__
+
+    @property
+    def help(self):
+        if not self.loaded and "_doc" in self.__dict__:
+            return self._doc or ""
+        return super().help
+
+    def dump(self):
+        """Return the manifest entry of this command."""
+        parameters = [
+            [name, int(param.kind), encode(param.default), encode(param.annotation)]
+            for name, param in self.spec.parameters.items()
+        ]
+        return {
+            "name": self.__name__,
+            "source": inspect.getsourcefile(self.command),
+            "doc": self.command.__doc__,
+            "async": self._async,
+            "extra": encode(self.extra),
+            "parameters": parameters,
+        }
+
+    def restore(self, entry):
+        """Use manifest `entry` instead of importing and inspecting."""
+        if self.__dict__.get("_entry") == entry:
+            return  # Restored by a previous run.
+        self._entry = entry
+        self.__name__ = entry["name"]
+        self._doc = entry["doc"]
+        self._async = entry["async"]
+        extra = decode(entry["extra"])
+        for key, value in self.extra.items():
+            extra.setdefault(key, {}).update(value)
+        self.extra = extra
+        self.changed()
+        self._parameters = entry["parameters"]
+
+    def load(self):
+        module_name, _, attr = self.path.partition(":")
+        with profile("import", command=self.path):
+            command = importlib.import_module(module_name)
+        for part in attr.split("."):
+            command = getattr(command, part)
+        if hasattr(command, "_cli"):
+            # Command decorated with @cli in its own module: keep its
+            # overrides, those given at registration take precedence.
+            extra = command._cli.extra
+            for key, value in self.extra.items():
+                extra.setdefault(key, {}).update(value)
+            self.extra = extra
+            self.changed()
+            app = command._cli.app
+            if app is not None and command._cli in app.registry:
+                app.unregister(command._cli)
+        command._cli = self
+        self.command = command
+        self.inspect()
+
+
+def encode(value):
+    """Turn `value` into JSON, referencing callables by their import path."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if value is NO_DEFAULT:
+        return {"empty": True}
+    if isinstance(value, (list, tuple)):
+        return {type(value).__name__: [encode(item) for item in value]}
+    if isinstance(value, dict):
+        return {"dict": {key: encode(item) for key, item in value.items()}}
+    module = getattr(value, "__module__", None)
+    qualname = getattr(value, "__qualname__", "")
+    if module and qualname and "<" not in qualname and callable(value):
+        return {"ref": f"{module}:{qualname}"}
+    raise Uncacheable(value)
+
+
+def decode(value):
+    if not isinstance(value, dict):
+        return value
+    ((kind, value),) = value.items()
+    if kind == "empty":
+        return NO_DEFAULT
+    if kind == "list":
+        return [decode(item) for item in value]
+    if kind == "tuple":
+        return tuple(decode(item) for item in value)
+    if kind == "dict":
+        return {key: decode(item) for key, item in value.items()}
+    module_name, _, qualname = value.partition(":")
+    value = importlib.import_module(module_name)
+    for part in qualname.split("."):
+        value = getattr(value, part)
+    return value
+
+
+def stat_source(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def write_manifest(path):
+    """Import all lazy commands and store their definition at `path`."""
+    manifest = {"version": MANIFEST_VERSION, "sources": {}, "commands": {}}
+    for cmd in current_app().registry:
+        if not isinstance(cmd, LazyCli):
+            continue
+        try:
+            entry = cmd.dump()
+        except (Uncacheable, TypeError):
+            entry = None  # Will be imported and inspected at each run.
+        else:
+            manifest["sources"][entry["source"]] = stat_source(entry["source"])
+        manifest["commands"][cmd.path] = entry
+    dump_json(path, manifest)
+    return manifest
+
+
+def dump_json(path, data):
+    """Write `data` as JSON at `path`, atomically."""
+    import json
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def is_fresh(manifest, commands):
+    if manifest.get("version") != MANIFEST_VERSION:
+        return False
+    if any(cmd.path not in manifest["commands"] for cmd in commands):
+        return False
+    try:
+        return all(
+            stat_source(source) == stat for source, stat in manifest["sources"].items()
+        )
+    except OSError:
+        return False
+
+
+def load_manifest(path):
+    """Define the lazy commands from the manifest at `path`.
+
+    Their modules are then imported only to actually run the command. The
+    manifest is rebuilt when missing or stale (a command module changed, or
+    a new command was registered).
+    """
+    with profile("manifest"):
+        _load_manifest(path)
+
+
+def _load_manifest(path):
+    import json
+
+    app = current_app()
+    commands = [cmd for cmd in app.registry if isinstance(cmd, LazyCli)]
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+    if manifest is None or not is_fresh(manifest, commands):
+        manifest = write_manifest(path)
+    app.help.update(manifest.get("help", {}))
+    for cmd in commands:
+        entry = manifest["commands"].get(cmd.path)
+        if entry and not cmd.loaded:
+            cmd.restore(entry)
+
+
+class App:
+    """Commands, wrappers and settings of a command line program.
+
+    Each App has its own registry, wrappers, settings, rendered help and
+    parsers; its run can be called many times, and from many threads. The
+    module level cli, wrap, lazy, configure, run… use the default App.
+    """
+
+    def __init__(self, **settings):
+        self.registry = []
+        self.wrappers = []
+        self.settings = dict(SETTINGS)
+        # Rendered help by command name ("" for the commands list):
+        # [digest, text], see cached_help.
+        self.help = {}
+        self.version = 0  # Changed with the commands, see parsers.
+        self.lock = threading.RLock()
+        self._parsers = None
+        self.configure(**settings)
+
+    def __repr__(self):
+        return f"<App {len(self.registry)} commands>"
+
+    def register(self, cmd):
+        cmd.app = self
+        self.registry.append(cmd)
+        self.version += 1
+        cmd.rank = self.version  # Registration order, see sort_commands.
+
+    def unregister(self, cmd):
+        self.registry.remove(cmd)
+        self.version += 1
+
+    def configure(self, **settings):
+        """Set minicli options, see SETTINGS for the available ones."""
+        for name in settings:
+            if name not in SETTINGS:
+                raise TypeError(f"Unknown setting {name!r}")
+        self.settings.update(settings)
+
+    def cli(self, *args, **kwargs):
+        if not args:
+            # User-friendlyness: allow using @cli() without any argument.
+            if kwargs:  # Overriding parser arguments with only kwargs.
+                return lambda f: self.cli(f, "__self__", **kwargs)
+            return self.cli
+        if not callable(args[0]):
+            # We are overriding an argument from the decorator.
+            return lambda f: self.cli(f, *args, **kwargs)
+        func = args[0]
+        if kwargs.get("fanout", FANOUT_POOLS[0]) not in FANOUT_POOLS:
+            raise ValueError(f"fanout must be one of {FANOUT_POOLS}")
+        if not isinstance(kwargs.get("cache", True), (bool, int, float)):
+            raise ValueError("cache must be True or a time to live in seconds")
+        extra = {}
+        if hasattr(func, "_cli") and len(args) > 1 and kwargs:
+            # Chaining cli(xxx) calls.
+            extra = func._cli.extra
+            func._cli.changed()  # Name may have been overridden.
+        if len(args) > 1:
+            extra[args[1]] = kwargs
+        cmd = Cli(func, **extra)
+        if func._cli is cmd:
+            self.register(cmd)
+        return func
+
+    def lazy(self, path, name=None, help=None, **kwargs):
+        """Register the command at `path` ("package.module:function") without
+        importing it.
+
+        The module is imported only when the command is invoked or its own
+        help is requested. `name` and `help` are used to list the command.
+        """
+        if name is not None:
+            kwargs["name"] = name
+        if help is not None:
+            kwargs["help"] = help
+        cmd = LazyCli(path, __self__=kwargs)
+        self.register(cmd)
+        return cmd
+
+    def wrap(self, func=None, provides=None):
+        """Register `func` as a wrapper; its yielded value is given to the
+        commands parameter named `provides`, if any."""
+        if func is None:
+            return lambda func: self.wrap(func, provides)
+        if not (inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func)):
+            raise ValueError(f'"{func}" needs to yield')
+        func._plan = compile_plan(inspect.signature(func))
+        func._provides = provides
+        self.wrappers.append(func)
+        for cmd in self.registry:
+            cmd.changed()  # May take the value yielded by this wrapper.
+        return func
+
+    @property
+    def resources(self):
+        """Names of the parameters given the value yielded by a wrapper."""
+        return {func._provides for func in self.wrappers if func._provides}
+
+    @contextlib.contextmanager
+    def active(self):
+        """Make this app the current one, see current_app."""
+        token = _app_var.set(self)
+        try:
+            yield self
+        finally:
+            _app_var.reset(token)
+
+    def run(self, *input, **shared):
+        if len(input) and callable(input[0]):
+            # The callable is the only command.
+            self.cli(input[0])
+            input = (input[0].__name__, *(input[1:] or sys.argv[1:]))
+        with self.active(), event_loop(), profiling():
+            _run(input, shared)
+
+    def run_batch(self, source, *input, separator="\n", wrap_each=False, **shared):
+        """Run each command line of `source` in this process.
+
+        `source` is a file path ("-" for stdin), a file object, or an iterable
+        of lines (strings or lists of args). Parsers are built once; a failing
+        line does not stop the batch, failures are summarized at the end.
+        Wrappers are called around the whole batch, or around each line if
+        `wrap_each`.
+        """
+        with self.active(), event_loop(), profiling():
+            _run(input, shared, batch=(source, separator, wrap_each))
+
+    def parsers(self, shared):
+        """Return the parsers for the global parameters `shared`, see
+        build_parsers. They are built again only when the commands change."""
+        key = (repr(shared), sys.argv[0], self.version, len(self.registry))
+        with self.lock:
+            if self._parsers is None or self._parsers[0] != key:
+                self._parsers = key, build_parsers(shared)
+            return self._parsers[1]
+
+    def serve(self, path, idle_timeout=600, **shared):
+        """Serve the commands on the Unix socket at `path`.
+
+        Command modules are imported and parsers built once in this process,
+        each command line sent by `python -m minicli.client` is then run in a
+        forked process, with the client cwd, environment and standard streams.
+        Stops after `idle_timeout` seconds without any request.
+        """
+        for cmd in self.registry:
+            if isinstance(cmd, LazyCli) and not cmd.loaded:
+                cmd.load()
+        # Built once here, with the arguments of every command (a copy of the
+        # registry, see add_commands): the forked processes inherit them.
+        with self.active():
+            _, _, _, subparsers, built = self.parsers(shared)
+            add_commands(subparsers, built, list(self.registry))
+        from .server import Server
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        with Server(path, idle_timeout, self, shared) as server:
+            try:
+                while not server.idle:
+                    server.handle_request()
+            finally:
+                os.unlink(path)
+
+    def completion(self, shell, prog=None):
+        """Return a completion script for `shell` (bash, zsh or fish).
+
+        The script is self-contained: completing does not start Python.
+        """
+        prog = prog or os.path.basename(sys.argv[0])
+        with self.active():
+            commands = completion_spec()
+        if shell == "bash":
+            return bash_completion(prog, commands)
+        if shell == "zsh":
+            init = "autoload -U +X bashcompinit && bashcompinit\n"
+            return init + bash_completion(prog, commands)
+        if shell == "fish":
+            return fish_completion(prog, commands)
+        raise ValueError(f"Unsupported shell {shell!r}")
+
+
+def current_app():
+    """Return the App being run, the default one outside of App.run."""
+    return _app_var.get(_app)
+
+
+_app = App()
+cli = _app.cli
+lazy = _app.lazy
+wrap = _app.wrap
+configure = _app.configure
+run = _app.run
+run_batch = _app.run_batch
+serve = _app.serve
+completion = _app.completion
+# The default App state, by its former names.
+_registry = _app.registry
+_wrapper_functions = _app.wrappers
+_settings = _app.settings
+_help = _app.help
+
+
+def start_profiler(output="-", memory=False, cprofile=None):
+    global _profiler
+    from .profiler import Profiler
+
+    _profiler = Profiler(output, memory, cprofile)
+    _profiler.active = True
+
+
+def profile(name, **meta):
+    """Time the `name` phase when profiling is enabled, do nothing otherwise."""
+    if _profiler is None:
+        return NO_PROFILE
+    return _profiler.phase(name, **meta)
+
+
+def measure(kind, name, **meta):
+    """Record the runtime metrics of the `name` command or wrapper to the
+    metrics sink of the app, if any, do nothing otherwise."""
+    sink = current_app().settings["metrics"]
+    if sink is None:
+        return NO_PROFILE
+    from .metrics import recorder
+
+    return recorder(sink).measure(kind, name, **meta)
+
+
+@contextlib.contextmanager
+def profiling():
+    """Emit the profiling report, if any, at the end of the outermost run."""
+    global _profiler
+    nested = _profiler is not None and _profiler.active
+    if _profiler is not None:
+        _profiler.active = True
+    try:
+        yield
+    finally:
+        if not nested and _profiler is not None:
+            profiler, _profiler = _profiler, None
+            profiler.stop()
+
+
+def new_event_loop():
+    factory = current_app().settings["loop_factory"]
+    if factory is None:
+        try:
+            import uvloop
+        except ImportError:
+            import asyncio
+
+            factory = asyncio.new_event_loop
+        else:
+            factory = uvloop.new_event_loop
+    return factory()
+
+
+def run_async(coroutine):
+    """Run `coroutine` in the event loop of the current run.
+
+    The loop is created on first use and kept until the end of the run, so
+    loop-bound resources (connection pools, clients…) can be shared by
+    wrappers and chained commands.
+    """
+    loop = _loop.get()
+    if loop is None:
+        loop = new_event_loop()
+        _loop.set(loop)
+    return loop.run_until_complete(coroutine)
+
+
+def close_event_loop():
+    loop = _loop.get()
+    _loop.set(None)
+    if loop is None:
         return
-    parser = argparse.ArgumentParser(add_help=False)
-    for arg_name, kwargs in shared.items():
-        if not isinstance(kwargs, dict):
-            kwargs = {"default": kwargs}
-        args, kwargs = make_argument(arg_name, **kwargs)
-        parser.add_argument(*args, **kwargs)
-    # shared must be parsed before actual commands so they can be passed to
-    # before wrapper
-    parsed, extras = parser.parse_known_args(input or None)
-    shared = {k: getattr(parsed, k, None) for k in shared.keys() if hasattr(parsed, k)}
-    # No command is known when calling parse_known_args, prevent argparse to
-    # display the help and exit.
+    try:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        if hasattr(loop, "shutdown_default_executor"):  # Python 3.9+.
+            loop.run_until_complete(loop.shutdown_default_executor())
+    finally:
+        loop.close()
+
+
+@contextlib.contextmanager
+def event_loop():
+    """Close the event loop of the run, if any, when leaving."""
+    owns_loop = _loop.get() is None  # run() may be called from a command.
+    try:
+        yield
+    finally:
+        if owns_loop:
+            close_event_loop()
+
+
+class Output:
+    """Buffered writer of the items yielded by generator commands.
+
+    Items are formatted as plain lines, JSON Lines, CSV rows or NUL
+    terminated strings, and written to stdout by chunks of about `size`
+    characters. Writing blocks while a slow reader catches up, so the
+    generator is only resumed once its items are written.
+    """
+
+    def __init__(self, format="lines", size=1 << 16):
+        self.format_item = getattr(self, f"format_{format}")
+        self.size = size
+        self.chunks = []
+        self.length = 0
+        self.header = None
+        self.lock = threading.RLock()  # Concurrent commands.
+        if format == "csv":
+            import csv
+
+            # writerow returns what write returns: the formatted row.
+            writer = types.SimpleNamespace(write=str)
+            self.csv = csv.writer(writer, lineterminator="\n")
+        elif format == "jsonl":
+            import json
+
+            self.dumps = json.JSONEncoder(default=str).encode
+
+    format_lines = "{}\n".format
+    format_nul = "{}\0".format
+
+    def format_jsonl(self, item):
+        return self.dumps(item) + "\n"
+
+    def format_csv(self, item):
+        header = ""
+        if isinstance(item, dict):
+            if self.header is None:
+                self.header = list(item)
+                header = self.csv.writerow(self.header)
+            item = [item.get(key) for key in self.header]
+        elif isinstance(item, str) or not hasattr(item, "__iter__"):
+            item = [item]
+        return header + self.csv.writerow(item)
+
+    def add(self, item):
+        text = self.format_item(item)
+        with self.lock:
+            self.chunks.append(text)
+            self.length += len(text)
+            if self.length >= self.size:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            text = "".join(self.chunks)
+            self.chunks.clear()
+            self.length = 0
+            if text:
+                sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def end(self):
+        self.header = None
+        self.flush()
+
+    def write_all(self, items):
+        """Write the items of the `items` generator."""
+        try:
+            try:
+                for item in items:
+                    self.add(item)
+            finally:
+                items.close()
+                self.end()
+        except BrokenPipeError:
+            stop_writing()
+
+    async def write_async(self, items):
+        """Write the items of the `items` async generator."""
+        try:
+            try:
+                async for item in items:
+                    self.add(item)
+            finally:
+                await items.aclose()
+                self.end()
+        except BrokenPipeError:
+            stop_writing()
+
+
+def stop_writing():
+    """Exit quietly when stdout was closed by the reader (`| head`)."""
+    try:
+        # Data still buffered must not raise again at exit.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+    except (OSError, ValueError):
+        pass
+    sys.exit(1)
+
+
+@contextlib.contextmanager
+def output(format):
+    """Write the items of generator commands in `format` while in this block."""
+    token = _output.set(Output(format))
+    try:
+        yield _output.get()
+    finally:
+        _output.reset(token)
+
+
+def current_output():
+    return _output.get() or Output(current_app().settings["format"])
+
+
+def _run(input, shared, batch=None):
+    app = current_app()
+    spec = shared  # Global parameters, as given.
+    with app.lock:  # Parsers are shared by the runs of the app.
+        # shared must be parsed before actual commands so they can be passed
+        # to before wrapper
+        with profile("parse_shared"):
+            argv = list(input) if input else sys.argv[1:]
+            if not shared and not any(
+                token.partition("=")[0] in BUILTIN_FLAGS for token in argv
+            ):  # Nothing to parse here, argparse may not be needed at all.
+                options, parsed, extras = dict.fromkeys(BUILTIN_OPTIONS), None, argv
+            else:
+                builtins, parser = app.parsers(shared)[:2]
+                options, argv = split_builtins(builtins, argv)
+                split = split_shared(parser, argv)
+                if split is None:
+                    parsed, extras = parser.parse_known_args(argv)
+                else:
+                    parsed, rest = parser.parse_known_args(split[0])
+                    extras = rest + split[1]
+        if options["minicli_profile"] and _profiler is None:
+            start_profiler(
+                options["minicli_profile"],
+                options["minicli_profile_memory"],
+                options["minicli_profile_cprofile"],
+            )
+        if app.settings["manifest"]:
+            load_manifest(app.settings["manifest"])
+        shared = {k: getattr(parsed, k) for k in shared.keys() if hasattr(parsed, k)}
+        if options["minicli_batch"]:
+            separator = "\0" if options["minicli_batch_null"] else "\n"
+            batch = (options["minicli_batch"], separator, False)
+        if not batch:
+            text = cached_help(spec, extras)
+            if text is not None:
+                sys.stdout.write(text)
+                sys.exit(0)  # Like argparse.
+            commands = parse_input(spec, extras)
+    if batch:
+        run_lines(spec, options, shared, *batch)
+        return
+
+    # Now call commands for real.
+    wrappers = prepare_wrappers(**shared)
+    token = _resources.set(call_wrappers(wrappers))
+    try:
+        call_commands(commands, options, **shared)
+    finally:
+        _resources.reset(token)
+        call_wrappers(wrappers)
+
+
+def build_parsers(shared):
+    """Return the parser of the builtin options, the parser of the global
+    parameters `shared`, the parser of the commands, its subparsers, and the
+    commands added to them so far (see add_commands)."""
+    from .parser import Parser
+
+    # Never matched by abbreviation: a command option must not be taken.
+    builtins = Parser(add_help=False, allow_abbrev=False)
+    for name, kwargs in BUILTIN_OPTIONS.items():
+        if name not in shared:
+            flag = "--{}".format(name.replace("_", "-"))
+            builtins.add_argument(flag, dest=name, **kwargs)
+    parsers = []
+    for _ in range(2):
+        parser = Parser(add_help=False)
+        for arg_name, kwargs in shared.items():
+            if not isinstance(kwargs, dict):
+                kwargs = {"default": kwargs}
+            args, kwargs = make_argument(arg_name, **kwargs)
+            parser.add_argument(*args, **kwargs)
+        parsers.append(parser)
+    # The global parameters parser has no help: no command is known when
+    # calling parse_known_args, prevent argparse to display the help and exit.
     parser.add_argument(
         "-h", "--help", action="store_true", help="Show this help message and exit"
     )
     subparsers = parser.add_subparsers(title="Available commands", metavar="")
-    for cmd in _registry:
-        cmd.init_parser(subparsers)
+    return builtins, parsers[0], parser, subparsers, {}
+
+
+def split_builtins(parser, argv):
+    """Return the builtin options given before the first command of `argv`,
+    and the other args.
+
+    The options given after it belong to the commands, even when named like
+    a builtin one.
+    """
+    options = dict.fromkeys(BUILTIN_OPTIONS)
+    flags = parser._option_string_actions
+    if not any(token.partition("=")[0] in flags for token in argv):
+        return options, argv
+    registry = current_app().registry
+    end = next(
+        (
+            index
+            for index, token in enumerate(argv)
+            if token[:1] != "-" and any(token in cmd.names for cmd in registry)
+        ),
+        len(argv),
+    )
+    parsed, rest = parser.parse_known_args(argv[:end])
+    options.update(vars(parsed))
+    return options, rest + argv[end:]
 
+
+def cached_help(spec, extras):
+    """Return the help asked by `extras`, None if this is not a help request.
+
+    The help of the commands list and of each command is rendered once, then
+    kept in memory and in the manifest, if any, until any of its inputs (prog,
+    terminal width, global parameters `spec`, commands definition) changes.
+    The parsers are only built to render it.
+    """
+    app = current_app()
+    if len(extras) == 1 and extras[0] in HELP_FLAGS:
+        cmd = None
+    elif len(extras) == 2 and extras[1] in HELP_FLAGS:
+        cmd = next((cmd for cmd in app.registry if extras[0] in cmd.names), None)
+        if cmd is None:
+            return None
+    else:
+        return None
+    with profile("help"):
+        import hashlib
+        import shutil
+
+        if cmd is None:
+            definition = [command.parser_kwargs() for command in app.registry]
+        else:
+            arguments = [
+                make_argument(arg_name, **cmd.parameter_kwargs(arg_name, parameter))
+                for arg_name, parameter in cmd.arguments()
+            ]
+            if any(extras[1] in args for args, _ in arguments):
+                return None  # A parameter named help.
+            definition = [cmd.parser_kwargs(), arguments]
+        width = shutil.get_terminal_size().columns
+        key = repr([sys.argv[0], width, repr(spec), definition])
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        target = extras[0] if cmd else ""
+        if app.help.get(target, [None])[0] == digest:
+            return app.help[target][1]
+        _, _, parser, subparsers, built = app.parsers(spec)
+        if cmd is None:
+            add_commands(subparsers, built, app.registry)
+            text = parser.format_help()
+        else:
+            add_commands(subparsers, built, [cmd])
+            text = cmd.parser.format_help()
+        app.help[target] = [digest, text]
+        if app.settings["manifest"]:
+            save_help(app.settings["manifest"])
+    return text
+
+
+def save_help(path):
+    """Store the rendered help in the manifest at `path`."""
+    import json
+
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return
+    manifest["help"] = current_app().help
+    dump_json(path, manifest)
+
+
+def parse_input(spec, extras):
+    """Return the commands parsed from `extras`, with the configured engine.
+
+    The parsers of the global parameters `spec` are only built when argparse
+    is needed, see App.parsers.
+    """
+    app = current_app()
+    engine = app.settings["parser"]
+    selected = select_commands(extras)
+    commands = None
+    if engine in ("fast", "check") and selected is not app.registry:
+        with profile("parse", engine="fast"):
+            commands = fast_parse(extras, {n: c for c in selected for n in c.names})
+    if commands is None or engine == "check":
+        _, _, parser, subparsers, built = app.parsers(spec)
+        add_commands(subparsers, built, selected)
+        try:
+            expected = parse_commands(parser, subparsers, built, extras, selected)
+        except SystemExit:
+            if commands is None:
+                raise
+            expected = None
+        if commands is not None:
+            check_conformance(extras, commands, expected)
+        commands = expected
+    check_sources(spec, commands)
+    if any(command.func.__self__.option("requires") for command in commands):
+        commands = add_requirements(*app.parsers(spec)[2:], commands)
+    return commands
+
+
+def check_sources(spec, commands):
+    """Report the `@file` values of the streamed and fan-out parameters that
+    cannot be read, before any command is called."""
+    for command in commands:
+        cmd = command.func.__self__
+        names = [name for name, _ in cmd.streamed]
+        if cmd.fanout:
+            names.append(cmd.fanout[0])
+        for name in names:
+            for value in getattr(command, name, None) or ():
+                if isinstance(value, str) and value.startswith("@"):
+                    try:
+                        open(value[1:]).close()
+                    except OSError as err:
+                        current_app().parsers(spec)[2].error(
+                            f"argument {name}: can't open {value[1:]!r}: {err}"
+                        )
+
+
+def add_requirements(parser, subparsers, built, commands):
+    """Add to the parsed `commands` the ones they require, parsed without
+    arguments, right before the first command requiring them; check that no
+    command requires itself."""
+    names = {name: cmd for cmd in current_app().registry for name in cmd.names}
+    chained = {command.func.__self__ for command in commands}
+    commands = list(commands)
+    index = 0
+    while index < len(commands):  # Grows with the requirements.
+        cmd = commands[index].func.__self__
+        added = []
+        for name in cmd.option("requires", ()):
+            if name not in names:
+                parser.error(f"{cmd.__name__} requires an unknown command: {name}")
+            if names[name] not in chained:
+                chained.add(names[name])
+                add_commands(subparsers, built, [names[name]])
+                required = [names[name]]
+                added += parse_commands(parser, subparsers, built, [name], required)
+        commands[index:index] = added  # Their own requirements come next.
+        index += not added
+    cycle = find_cycle(command_graph(commands))
+    if cycle:
+        cycle = " -> ".join(commands[index].func.__self__.__name__ for index in cycle)
+        parser.error(f"circular requirements: {cycle}")
+    return commands
+
+
+def add_commands(subparsers, built, selected):
+    """Add to `subparsers` the `selected` commands, see select_commands.
+
+    `built` tells, for each command already added, if its arguments were:
+    listing all the commands only needs their name and help.
+    """
+    full = selected is not current_app().registry
+    added = False
+    for cmd in selected:
+        if cmd not in built:
+            cmd.init_parser(subparsers, full)
+            built[cmd] = full or cmd.loaded
+            added = True
+        elif full and not built[cmd]:
+            with profile("init_parser", command=cmd.__name__):
+                cmd.add_arguments()
+            built[cmd] = True
+    if added and len(built) > 1:
+        sort_commands(subparsers, built)
+
+
+def sort_commands(subparsers, built):
+    """Order the `built` commands of `subparsers` as they were registered,
+    whatever the order they were added in: help and errors list them as
+    argparse always did."""
+    ranks = {name: cmd.rank for cmd in built for name in cmd.names}
+    choices = sorted(subparsers.choices.items(), key=lambda item: ranks[item[0]])
+    subparsers.choices.clear()
+    subparsers.choices.update(choices)
+    subparsers._choices_actions.sort(key=lambda action: ranks[action.dest])
+
+
+def parse_commands(parser, subparsers, built, extras, selected=()):
     # Parse all possible args before calling any func, to prevent considering
     # a wrong argument passed by mistake as a chained command.
+    with profile("parse"):
+        commands = parse_chain(extras, {n: cmd for cmd in selected for n in cmd.names})
+        if commands is not None:
+            return commands
+        registry = current_app().registry
+        if selected is not registry:
+            # Errors and help list the commands: they are only reported once
+            # all of them are added.
+            _parsing.quiet = True
+            try:
+                return parse_known_commands(parser, extras)
+            except ChainError:
+                add_commands(subparsers, built, registry)
+            finally:
+                _parsing.quiet = False
+        return parse_known_commands(parser, extras)
+
+
+def parse_known_commands(parser, extras):
+    """Parse the whole chain with argparse, one command after the other."""
     commands = []
     while extras:
         command, extras = parser.parse_known_args(args=extras)
         if not command or not hasattr(command, "func"):
+            if getattr(_parsing, "quiet", False):
+                raise ChainError("no command")
             # No argument given, just display help.
             parser.print_help()
             parser.exit()  # Mimic original behaviour.
         commands.append(command)
+    return commands
 
-    # Now call commands for real.
-    prepare_wrappers(**shared)
-    call_wrappers()
+
+class ChainError(Exception):
+    pass
+
+
+def chain_layout(parser):
+    """Return the number of positionals of `parser` (None if variable), and
+    the number of values taken by each of its options (None if variable)."""
+    positionals = 0
+    options = {}
+    for action in parser._actions:
+        if action.nargs is None:
+            count = 1
+        else:
+            count = action.nargs if isinstance(action.nargs, int) else None
+        if action.option_strings:
+            options.update(dict.fromkeys(action.option_strings, count))
+        elif count is None or positionals is None:
+            positionals = None
+        else:
+            positionals += count
+    return positionals, options
+
+
+def abbreviations(options):
+    """Return the abbreviations argparse accepts for the long `options`, but
+    the ones that are also an exact flag: argparse prefers the exact flag."""
+    return {
+        option[:end]
+        for option in options
+        if option.startswith("--")
+        for end in range(3, len(option))
+        if option[:end] not in options
+    }
+
+
+def claimed(token, name, owners, prefixes):
+    """Tell if argparse could give `token` to an earlier command of the chain
+    than the one having this exact flag: abbreviated, or a clustered short
+    option. `owners` and `prefixes` values start with the command rank."""
+    if name in prefixes and (name not in owners or prefixes[name] < owners[name][0]):
+        return True
+    return token[1:2] != "-" and len(token) > 2 and token[:2] in owners
+
+
+def split_chain(extras, index):
+    """Split `extras` in (command, args, moved) segments, one per chained
+    command.
+
+    Only the known commands names, and each command positionals and options
+    are used, so this is done in one pass. Like argparse, which gives each
+    command the rest of the chain, an option of an earlier command goes to
+    the first of them: it is moved, with its values, to its `moved` list.
+    Return None when this is not enough to be sure where a command ends.
+    """
+    segments = []
+    layouts = {}
+    registered = set()
+    owners = {}  # Flags of the earlier commands: rank, moved, values count.
+    prefixes = {}  # Their abbreviations: rank.
+    position = 0
+    while position < len(extras):
+        cmd = index.get(extras[position])
+        if cmd is None:
+            return None
+        if segments and segments[-1][0] not in registered:
+            previous, _, moved = segments[-1]  # First segment of this command.
+            rank = len(registered)
+            registered.add(previous)
+            for option, count in layouts[previous][1].items():
+                owners.setdefault(option, (rank, moved, count))
+            for prefix in abbreviations(layouts[previous][1]):
+                prefixes.setdefault(prefix, rank)
+        if cmd not in layouts:
+            layouts[cmd] = chain_layout(cmd.parser)
+        positionals, options = layouts[cmd]
+        args = []
+        position += 1
+        seen = 0
+        while position < len(extras):
+            token = extras[position]
+            if token.startswith("-") and token != "-":
+                name, equal, value = token.partition("=")
+                if not (name.startswith("--") and equal):
+                    name = token
+                if claimed(token, name, owners, prefixes):
+                    return None
+                _, moved, count = owners.get(name, (None, None, options.get(name)))
+                if count is None or (equal and not count):
+                    return None  # Unknown, abbreviated, negative number…
+                values = [] if equal else extras[position + 1 : position + 1 + count]
+                if len(values) < (0 if equal else count) or any(
+                    value.startswith("-") for value in values
+                ):
+                    return None
+                if moved is None:
+                    args += extras[position : position + 1 + len(values)]
+                else:
+                    moved.append((name, [value] if equal else values))
+                position += 1 + len(values)
+                continue
+            if positionals is not None and seen >= positionals and token in index:
+                break  # Next command.
+            args.append(token)
+            seen += 1
+            position += 1
+        segments.append((cmd, args, []))
+    return segments
+
+
+def split_shared(parser, argv):
+    """Split `argv` in global parameters args and the others, in one pass.
+
+    Return None when argparse could match some args in other ways
+    (abbreviations, clustered short options…).
+    """
+    _, options = chain_layout(parser)
+    longs = [option for option in options if option.startswith("--")]
+    shared = []
+    extras = []
+    position = 0
+    while position < len(argv):
+        token = argv[position]
+        name, equal, _ = token.partition("=")
+        if not (name.startswith("--") and equal):
+            name = token
+        if name in options:
+            count = options[name]
+            if count is None:
+                return None
+            values = [] if equal else argv[position + 1 : position + 1 + count]
+            if any(value.startswith("-") for value in values):
+                return None
+            shared += argv[position : position + 1 + len(values)]
+            position += 1 + len(values)
+            continue
+        if token == "--" or (
+            token.startswith("--") and any(option.startswith(name) for option in longs)
+        ):
+            return None
+        if token[:1] == "-" and token[1:2] != "-" and token[:2] in options:
+            return None
+        extras.append(token)
+        position += 1
+    return shared, extras
+
+
+def parse_chain(extras, index):
+    """Parse each command of the chain with its own parser only.
+
+    The options moved to an earlier command are then given to its actions,
+    as argparse does, without parsing its args again. Return None if not
+    possible, parse_commands then falls back to argparse parsing the whole
+    chain, and reporting errors if any.
+    """
+    import argparse
+
+    if not extras:
+        return None
+    segments = split_chain(extras, index)
+    if segments is None:
+        return None
+    commands = []
+    _parsing.quiet = True
+    try:
+        for cmd, args, _ in segments:
+            command, rest = cmd.parser.parse_known_args(args)
+            if rest:
+                return None
+            commands.append(command)
+        for (cmd, _, moved), command in zip(segments, commands):
+            parser = cmd.parser
+            for option, values in moved:
+                action = parser._option_string_actions[option]
+                action(parser, command, parser._get_values(action, values), option)
+    except (ChainError, argparse.ArgumentError):
+        return None
+    finally:
+        _parsing.quiet = False
+    return commands
+
+
+def compile_table(cmd):
+    """Return the lookup tables of the fast parser for `cmd`.
+
+    That is the positionals, the options by flag, the default values, and the
+    options whose string default is converted by their type. Return None if
+    an override is not understood: the command is then parsed by argparse.
+    """
+    positionals = []
+    options = {"-h": None, "--help": None}
+    defaults = {"func": cmd.invoke}
+    converted = []
+    for arg_name, parameter in cmd.arguments():
+        kwargs = cmd.parameter_kwargs(arg_name, parameter)
+        args, kwargs = make_argument(arg_name, **kwargs)
+        action = kwargs.get("action")
+        type_ = kwargs.get("type")
+        nargs = kwargs.pop("nargs", None)
+        if (
+            not FAST_KWARGS.issuperset(kwargs)
+            or action not in FAST_ACTIONS
+            or (type_ is not None and not callable(type_))
+        ):
+            return None
+        if args[0].startswith("-"):
+            default = kwargs["default"]
+            if nargs or (action == "append" and not isinstance(default, LISTS)):
+                return None
+            entry = (kwargs["dest"], action, type_, kwargs.get("choices"))
+            options.update(dict.fromkeys(args, entry))
+            defaults[kwargs["dest"]] = default
+            if type_ is not None and isinstance(default, str):
+                converted.append((kwargs["dest"], type_))
+        else:
+            if (
+                action not in (None, "store")
+                or "dest" in kwargs
+                or nargs not in (None, "*")
+                or (nargs and "choices" in kwargs)
+                or (positionals and positionals[-1][1])
+            ):
+                return None
+            positionals.append((args[0], nargs, type_, kwargs.get("choices")))
+            defaults[args[0]] = None
+    return positionals, options, defaults, converted
+
+
+def convert(value, type_, choices):
+    """Return `value` converted by `type_`, or raise ChainError like argparse
+    would report an error."""
+    if type_ is not None:
+        try:
+            value = type_(value)
+        except Exception as err:
+            raise ChainError(str(err))
+    if choices is not None and value not in choices:
+        raise ChainError(f"invalid choice: {value!r}")
+    return value
+
+
+def fast_parse(extras, index):
+    """Parse `extras` straight from the commands lookup tables.
+
+    Like split_chain, an option of an earlier command goes to the first of
+    them. Return None when argparse is needed: help, errors, and anything that
+    could be matched in other ways (abbreviations, negative numbers…).
+    """
+    commands = []
+    registered = set()
+    owners = {}  # Flags of the earlier commands: rank, values, seen, entry.
+    prefixes = {}  # Their abbreviations: rank.
+    position = 0
     try:
+        while position < len(extras):
+            cmd = index.get(extras[position])
+            if cmd is None or cmd.table is None:
+                return None
+            positionals, options, defaults, converted = cmd.table
+            values = dict(defaults)
+            given = []
+            seen = set()
+            variable = bool(positionals) and positionals[-1][1] is not None
+            fixed = len(positionals) - variable
+            position += 1
+            while position < len(extras):
+                token = extras[position]
+                position += 1
+                if token[:1] != "-" or token == "-":
+                    if variable and seen:
+                        return None  # argparse may consume *args too early.
+                    if not variable and len(given) == fixed:
+                        if token not in index:
+                            return None
+                        position -= 1
+                        break  # Next command.
+                    given.append(token)
+                    continue
+                name, equal, value = token.partition("=")
+                if not (name.startswith("--") and equal):
+                    name, equal = token, ""
+                if claimed(token, name, owners, prefixes):
+                    return None
+                _, target, done, entry = owners.get(
+                    name, (None, values, seen, options.get(name))
+                )
+                if entry is None:
+                    return None  # Help, unknown, abbreviated, negative number…
+                dest, action, type_, choices = entry
+                if action in ("store_true", "store_false"):
+                    if equal:
+                        return None
+                    target[dest] = action == "store_true"
+                    done.add(dest)
+                    continue
+                if not equal:
+                    if position == len(extras):
+                        return None
+                    value = extras[position]
+                    if value[:1] == "-" and value != "-":
+                        return None
+                    position += 1
+                value = convert(value, type_, choices)
+                if action == "append":
+                    if dest not in done:
+                        target[dest] = list(target[dest] or [])
+                    target[dest].append(value)
+                else:
+                    target[dest] = value
+                done.add(dest)
+            if len(given) < fixed:
+                return None
+            for (dest, nargs, type_, choices), value in zip(positionals, given):
+                values[dest] = convert(value, type_, choices)
+            if variable:
+                dest, _, type_, _ = positionals[-1]
+                values[dest] = [convert(value, type_, None) for value in given[fixed:]]
+            for dest, type_ in converted:
+                if dest not in seen:
+                    values[dest] = convert(values[dest], type_, None)
+            commands.append(types.SimpleNamespace(**values))
+            if cmd not in registered:
+                rank = len(registered)
+                registered.add(cmd)
+                values = vars(commands[-1])  # Later options still update it.
+                for option, entry in options.items():
+                    owners.setdefault(option, (rank, values, seen, entry))
+                for prefix in abbreviations(options):
+                    prefixes.setdefault(prefix, rank)
+    except ChainError:
+        return None
+    return commands
+
+
+def check_conformance(extras, commands, expected):
+    """Raise AssertionError if fast_parse and argparse disagree."""
+
+    def calls(commands):
+        if commands is None:
+            return None
+        # The raw values: Cli.bind would wrap the streamed ones in generators.
+        return [
+            (c.func.__self__, bind(c.func.__self__.plan, vars(c))) for c in commands
+        ]
+
+    fast, reference = calls(commands), calls(expected)
+    if fast != reference:
+        raise AssertionError(
+            f"Fast parser mismatch for {extras}: {fast} != argparse {reference}"
+        )
+
+
+def call_commands(commands, options, **shared):
+    with output(options["minicli_format"] or current_app().settings["format"]):
+        _call_commands(commands, options, **shared)
+
+
+def _call_commands(commands, options, **shared):
+    concurrency = current_app().settings["concurrency"]
+    if any(command.func.__self__.scheduled for command in commands):
+        run_graph(commands, options["minicli_jobs"] or concurrency, options, **shared)
+    elif options["minicli_parallel"] or concurrency:
+        run_concurrently(commands, concurrency, options=options, **shared)
+    else:
         for command in commands:
-            command.func(command, **shared)
+            cmd = command.func.__self__
+            with profile("command", command=cmd.__name__), measure(
+                "command", cmd.__name__
+            ):
+                if cmd.fanout:
+                    run_async(fanout(command, options, shared))
+                elif cmd.cache:
+                    from .cache import cached_call
+
+                    cached_call(
+                        cmd, command, shared, refresh=options["minicli_no_cache"]
+                    )
+                else:
+                    command.func(command, **shared)
+
+
+async def fanout(command, options, shared):
+    """Run the command once per value of its fan-out parameter.
+
+    Values are given on the command line, `@file` and `-` (stdin) being read
+    one value per line. Calls are spread over a pool of `--minicli-jobs`
+    processes or threads. The returned or yielded items of each call are
+    written to the output in the values order, or as they complete with
+    `--minicli-unordered`.
+    Failures do not stop the other calls, the exit status is the highest one.
+    """
+    import asyncio
+    import concurrent.futures
+
+    cmd = command.func.__self__
+    name, pool = cmd.fanout
+    values = {**vars(command), **shared}
+    if pool == "thread":
+        values.update(_resources.get())  # Worker processes have their own.
+    values = {key: values.get(key) for key, _ in cmd.plan}
+    type_ = cmd.value_type(name)
+    jobs = options.get("minicli_jobs") or os.cpu_count() or 1
+    in_loop = pool == "thread" and (
+        cmd._async or inspect.isasyncgenfunction(cmd.command)
+    )
+    if pool == "process":
+        executor = concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=init_worker, initargs=(current_app().wrappers, shared)
+        )
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(jobs)
+    semaphore = asyncio.Semaphore(jobs)
+    loop = asyncio.get_running_loop()
+    args = (cmd.command, cmd.plan, values, name, type_)
+
+    async def call(chunk):
+        if in_loop:
+            async with semaphore:
+                return chunk, [await call_item_async(*args, chunk[0])]
+        return chunk, await loop.run_in_executor(executor, call_items, *args, chunk)
+
+    def chunks():
+        # Values are sent to the workers by growing chunks, to save round
+        # trips while keeping every worker busy when there are few values.
+        chunk = []
+        size = 1
+        for count, value in enumerate(expand_values(vars(command)[name]), 1):
+            chunk.append(value)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+                if not in_loop:
+                    size = min(FANOUT_CHUNK, max(1, count // (jobs * 4)))
+        if chunk:
+            yield chunk
+
+    out = current_output()
+    ordered = not options.get("minicli_unordered")
+    pending = collections.deque() if ordered else set()
+    total = failed = status = 0
+
+    async def collect(limit):
+        nonlocal pending, failed, status
+        while len(pending) > limit:
+            if ordered:
+                done = [pending.popleft()]
+                await done[0]
+            else:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+            for task in done:
+                for value, (items, code, message) in zip(*task.result()):
+                    for item in items:
+                        out.add(item)
+                    if code:
+                        failed += 1
+                        status = max(status, code)
+                        sys.stderr.write(f"Item {value} failed\n{message}")
+
+    try:
+        with executor:
+            try:
+                for chunk in chunks():
+                    total += len(chunk)
+                    task = asyncio.ensure_future(call(chunk))
+                    if ordered:
+                        pending.append(task)
+                    else:
+                        pending.add(task)
+                    # Values are read (from stdin…) as the calls complete.
+                    await collect(jobs * 4)
+                await collect(0)
+            finally:
+                for task in pending:
+                    task.cancel()
+                out.end()
+    except BrokenPipeError:
+        stop_writing()
+    if failed:
+        print(f"{failed} of {total} items failed", file=sys.stderr)
+        sys.exit(status)
+
+
+def expand_values(values):
+    """Yield `values`, reading one value per line of `@file` and `-` (stdin)."""
+    for value in values:
+        if value == "-":
+            yield from filter(None, read_items(sys.stdin))
+        elif value.startswith("@"):
+            with open(value[1:]) as file:
+                yield from filter(None, read_items(file))
+        else:
+            yield value
+
+
+def stream_values(values, type_=None):
+    """Yield `values` as expand_values does, converted by `type_`."""
+    for value in expand_values(values):
+        if type_ is not None:
+            try:
+                value = type_(value)
+            except (TypeError, ValueError):
+                name = getattr(type_, "__name__", repr(type_))
+                sys.exit(f"invalid {name} value: {value!r}")
+        yield value
+
+
+def call_items(command, plan, values, name, type_, chunk):
+    return [call_item(command, plan, values, name, type_, value) for value in chunk]
+
+
+def call_item(command, plan, values, name, type_, value):
+    """Call `command` with `value` as `name`, in a fan-out worker.
+
+    Return the items to write (the returned value, or the yielded ones), the
+    exit status and the error message.
+    """
+    try:
+        resources = _resources.get()  # Of the worker process, if any.
+        values = {**values, **resources, name: type_(value) if type_ else value}
+        args, kwargs = bind(plan, values)
+        result = command(*args, **kwargs)
+        if inspect.iscoroutine(result):
+            result = run_async(result)
+        elif inspect.isasyncgen(result):
+            result = run_async(collect_async(result))
+        if inspect.isgenerator(result):
+            result = list(result)
+        elif not isinstance(result, list):
+            result = [] if result is None else [result]
+        return result, 0, ""
+    except (Exception, SystemExit) as err:
+        return ([], *item_error(err))
+
+
+async def call_item_async(command, plan, values, name, type_, value):
+    """Like call_item, for async commands run in the event loop."""
+    try:
+        values = {**values, name: type_(value) if type_ else value}
+        args, kwargs = bind(plan, values)
+        result = command(*args, **kwargs)
+        if inspect.isasyncgen(result):
+            result = await collect_async(result)
+        else:
+            result = await result
+            result = [] if result is None else [result]
+        return result, 0, ""
+    except (Exception, SystemExit) as err:
+        return ([], *item_error(err))
+
+
+async def collect_async(items):
+    return [item async for item in items]
+
+
+def item_error(err):
+    """Return the exit status and the message of a fan-out call failure."""
+    import traceback
+
+    if not isinstance(err, SystemExit):
+        return 1, "".join(traceback.format_exception(type(err), err, err.__traceback__))
+    if err.code is None or isinstance(err.code, int):
+        return err.code or 0, ""
+    return 1, f"{err.code}\n"
+
+
+def init_worker(wrappers, shared):
+    """Set up a fan-out worker process: its own event loop and `wrappers`,
+    finalized when the worker exits."""
+    import multiprocessing.util
+
+    # Inherited from the parent process.
+    _loop.set(None)
+    _output.set(None)
+    generators = _prepare_wrappers(wrappers, shared)
+    _resources.set(call_wrappers(generators))
+    multiprocessing.util.Finalize(None, end_worker, args=(generators,), exitpriority=0)
+
+
+def end_worker(generators):
+    try:
+        call_wrappers(generators)
+    finally:
+        close_event_loop()
+        if "minicli.metrics" in sys.modules:
+            # Worker processes exit without running the atexit functions.
+            sys.modules["minicli.metrics"].flush()
+
+
+def read_items(file, separator="\n", size=1 << 16):
+    """Yield the `separator` separated items of `file`, reading by chunks."""
+    rest = ""
+    while True:
+        chunk = file.read(size)
+        if not chunk:
+            break
+        *items, rest = (rest + chunk).split(separator)
+        yield from items
+    if rest:
+        yield rest
+
+
+def iter_lines(source, separator):
+    if isinstance(source, str):
+        if source == "-":
+            yield from read_items(sys.stdin, separator)
+        else:
+            with open(source) as file:
+                yield from read_items(file, separator)
+    elif hasattr(source, "read"):
+        yield from read_items(source, separator)
+    else:
+        yield from source
+
+
+def run_lines(spec, options, shared, source, separator, wrap_each):
+    import shlex
+    import traceback
+
+    app = current_app()
+    if not wrap_each:
+        wrappers = prepare_wrappers(**shared)
+        token = _resources.set(call_wrappers(wrappers))
+    total = failed = 0
+    try:
+        for number, line in enumerate(iter_lines(source, separator), 1):
+            args = shlex.split(line) if isinstance(line, str) else list(line)
+            if not args:
+                continue
+            total += 1
+            try:
+                with app.lock:
+                    commands = parse_input(spec, args)
+                if wrap_each:
+                    wrappers = prepare_wrappers(**shared)
+                    token = _resources.set(call_wrappers(wrappers))
+                try:
+                    call_commands(commands, options, **shared)
+                finally:
+                    if wrap_each:
+                        _resources.reset(token)
+                        call_wrappers(wrappers)
+            except SystemExit as err:
+                if err.code in (None, 0):
+                    continue
+                if not isinstance(err.code, int):
+                    print(err.code, file=sys.stderr)
+                print(f"Line {number} failed: {line}", file=sys.stderr)
+                failed += 1
+            except Exception:
+                traceback.print_exc()
+                print(f"Line {number} failed: {line}", file=sys.stderr)
+                failed += 1
     finally:
-        call_wrappers()
+        if not wrap_each:
+            _resources.reset(token)
+            call_wrappers(wrappers)
+    print(f"{total} lines run, {failed} failed", file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+def run_concurrently(commands, workers=None, options=None, **shared):
+    """Run parsed `commands` at the same time, at most `workers` at once.
+
+    Async commands run in the event loop of the run, sync ones in a thread
+    pool. Every command is run even if another one fails; failures are then
+    reported and the run exits with the highest exit status.
+    """
+    import asyncio
+    import concurrent.futures
+
+    async def call(pool, semaphore, command):
+        async with semaphore:
+            try:
+                await call_command(pool, command, options or {}, shared)
+            except (Exception, SystemExit) as err:
+                return command.func.__self__, err
+
+    async def gather():
+        semaphore = asyncio.Semaphore(workers or len(commands) or 1)
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            calls = (call(pool, semaphore, command) for command in commands)
+            return await asyncio.gather(*calls)
+
+    status = report_failures(run_async(gather()))
+    if status:
+        sys.exit(status)
+
+
+async def call_command(pool, command, options, shared):
+    """Call the parsed `command` in the event loop, or in the thread `pool`
+    if it is sync; replay its cached output, if any."""
+    cmd = command.func.__self__
+    if cmd.cache and not cmd.fanout:
+        from .cache import cached
+
+        format = options.get("minicli_format") or current_app().settings["format"]
+        refresh = options.get("minicli_no_cache")
+        # Its own Output: the items yielded by the others are not stored.
+        with cached(cmd, command, shared, refresh) as run, output(format):
+            if run:
+                await _call_command(pool, command, options, shared)
+    else:
+        await _call_command(pool, command, options, shared)
+
+
+async def _call_command(pool, command, options, shared):
+    import asyncio
+
+    cmd = command.func.__self__
+    args, kwargs = cmd.bind(command, **shared)
+    if _profiler is not None:
+        # Concurrent: durations overlap.
+        _profiler.mark("command", command=cmd.__name__)
+    with measure("command", cmd.__name__):
+        if cmd.fanout:
+            await fanout(command, options, shared)
+        elif cmd._async:
+            await cmd.command(*args, **kwargs)
+        elif inspect.isasyncgenfunction(cmd.command):
+            await current_output().write_async(cmd.command(*args, **kwargs))
+        else:
+            # Sync commands write to the Output of the run.
+            context = contextvars.copy_context()
+            func = functools.partial(context.run, cmd, *args, **kwargs)
+            await asyncio.get_running_loop().run_in_executor(pool, func)
+
+
+def report_failures(failures):
+    """Report the (cmd, error) `failures` (None for a success), return the
+    highest exit status."""
+    import traceback
+
+    status = 0
+    for failure in failures:
+        if failure is None:
+            continue
+        cmd, err = failure
+        if isinstance(err, SystemExit):
+            if err.code in (None, 0):
+                continue
+            code = err.code if isinstance(err.code, int) else 1
+            if not isinstance(err.code, int):
+                print(err.code, file=sys.stderr)
+        else:
+            code = 1
+            print(f"Command {cmd.__name__} failed:", file=sys.stderr)
+            traceback.print_exception(type(err), err, err.__traceback__)
+        status = max(status, code)
+    return status
+
+
+def run_graph(commands, workers=None, options=None, **shared):
+    """Run parsed `commands` once the commands they require are done, at
+    most `workers` at once.
+
+    Independent commands run at the same time, as with run_concurrently.
+    A command whose outputs are newer than its inputs is skipped; the
+    commands requiring a failed one are not run, the others are. Failures
+    are then reported and the run exits with the highest exit status.
+    """
+    import asyncio
+    import concurrent.futures
+
+    graph = command_graph(commands)
+    pending = {index: set(required) for index, required in graph.items()}
+    dependents = collections.defaultdict(list)
+    for index, required in graph.items():
+        for other in required:
+            dependents[other].append(index)
+    stopped = set()  # Failed, or requiring a stopped command.
 
+    async def call(pool, semaphore, index):
+        command = commands[index]
+        cmd = command.func.__self__
+        if graph[index] & stopped:
+            stopped.add(index)
+            print(f"Command {cmd.__name__} not run", file=sys.stderr)
+            return None
+        if up_to_date(cmd, {**vars(command), **shared}):
+            print(f"Command {cmd.__name__} is up to date", file=sys.stderr)
+            return None
+        async with semaphore:
+            try:
+                await call_command(pool, command, options or {}, shared)
+            except (Exception, SystemExit) as err:
+                if not (isinstance(err, SystemExit) and err.code in (None, 0)):
+                    stopped.add(index)
+                return cmd, err
 
-def _run_single(method, *input, **shared):
-    cli(method)
-    name = method.__name__
-    run(name, *input or sys.argv[1:], **shared)
+    async def schedule():
+        semaphore = asyncio.Semaphore(workers or os.cpu_count() or 1)
+        failures = []
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            running = {}
+            ready = [index for index, required in pending.items() if not required]
+            while ready or running:
+                for index in sorted(ready):
+                    task = asyncio.ensure_future(call(pool, semaphore, index))
+                    running[task] = index
+                ready = []
+                done, _ = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    failures.append(task.result())
+                    finished = running.pop(task)
+                    for index in dependents[finished]:
+                        pending[index].discard(finished)
+                        if not pending[index]:
+                            ready.append(index)
+        return failures
+
+    status = report_failures(run_async(schedule()))
+    if status:
+        sys.exit(status)
+
+
+def command_graph(commands):
+    """Return, for each index of the parsed `commands`, the indexes of the
+    commands it requires.
+
+    A command neither scheduled nor required keeps its command line order: it
+    requires the commands before it, and the commands after it require it.
+    """
+    indexes = collections.defaultdict(set)
+    for index, command in enumerate(commands):
+        for name in command.func.__self__.names:
+            indexes[name].add(index)
+    graph = {
+        index: {
+            required
+            for name in command.func.__self__.option("requires", ())
+            for required in indexes[name]
+        }
+        for index, command in enumerate(commands)
+    }
+    required = set().union(*graph.values())
+    last = set()  # The last command keeping its order.
+    since = set()  # The commands after it.
+    for index, command in enumerate(commands):
+        if command.func.__self__.scheduled or index in required:
+            graph[index] |= last
+            since.add(index)
+        else:
+            graph[index] |= last | since
+            last, since = {index}, set()
+    return graph
+
+
+def find_cycle(graph):
+    """Return the indexes of a cycle in `graph` (from command_graph), the
+    first one repeated at the end, or None."""
+    visited = set()
+    for start in graph:
+        if start in visited:
+            continue
+        visited.add(start)
+        path = [start]
+        stack = [iter(sorted(graph[start]))]
+        on_path = {start}
+        while stack:
+            for required in stack[-1]:
+                if required in on_path:
+                    return path[path.index(required) :] + [required]
+                if required not in visited:
+                    visited.add(required)
+                    path.append(required)
+                    stack.append(iter(sorted(graph[required])))
+                    on_path.add(required)
+                    break
+            else:
+                on_path.discard(path.pop())
+                stack.pop()
+    return None
+
+
+def up_to_date(cmd, values):
+    """Tell if `cmd` declares outputs, all newer than its inputs."""
+    outputs = cmd.paths("outputs", values)
+    if not outputs:
+        return False
+    try:
+        oldest = min(os.stat(path).st_mtime_ns for path in outputs)
+        inputs = [os.stat(path).st_mtime_ns for path in cmd.paths("inputs", values)]
+    except OSError:
+        return False
+    return all(mtime <= oldest for mtime in inputs)
+
+
+def select_commands(extras):
+    """Return the commands whose parser is needed to parse `extras`.
+
+    Only the invoked command, and the ones it may be chained with, are built;
+    the whole registry is only needed to display the help or to report an
+    error, see parse_commands.
+    """
+    registry = current_app().registry
+    tokens = set(extras)
+    selected = [cmd for cmd in registry if not tokens.isdisjoint(cmd.names)]
+    if not extras or not any(extras[0] in cmd.names for cmd in selected):
+        return registry
+    return selected
+
+
+def completion_spec():
+    """Return names, help, options and positional choices of each command."""
+    commands = []
+    for cmd in current_app().registry:
+        options = [(["-h", "--help"], False, [], "Show this help message and exit")]
+        positionals = []
+        for arg_name, parameter in cmd.arguments():
+            args, kwargs = make_argument(
+                arg_name, **cmd.parameter_kwargs(arg_name, parameter)
+            )
+            choices = [str(choice) for choice in kwargs.get("choices") or []]
+            if args[0].startswith("-"):
+                takes_value = kwargs.get("action") not in ("store_true", "store_false")
+                options.append((args, takes_value, choices, kwargs.get("help", "")))
+            else:
+                positionals.extend(choices)
+        names = sorted(cmd.names, key=lambda name: "_" in name)
+        commands.append((names, cmd.short_help, options, positionals))
+    return commands
+
+
+BASH_COMPLETION = """\
+_minicli_{func}() {{
+    local cur prev cmd words i
+    cur="${{COMP_WORDS[COMP_CWORD]}}"
+    prev="${{COMP_WORDS[COMP_CWORD-1]}}"
+    cmd=""
+    for ((i=COMP_CWORD-1; i>0; i--)); do
+        case "${{COMP_WORDS[i]}}" in
+{commands}
+        esac
+    done
+    words={names}
+    case "$cmd" in
+{options}
+    esac
+    COMPREPLY=($(compgen -W "$words" -- "$cur"))
+}}
+complete -o default -F _minicli_{func} {prog}
+"""
+
+
+def bash_completion(prog, commands):
+    import shlex
+
+    func = re.sub(r"\W", "_", prog)
+    names = " ".join(name for cmd_names, *_ in commands for name in cmd_names)
+    cases, options = [], []
+    for index, (cmd_names, _, cmd_options, positionals) in enumerate(commands):
+        pattern = "|".join(shlex.quote(name) for name in cmd_names)
+        cases.append(f"            {pattern}) cmd={index}; break;;")
+        words = [flag for args, *_ in cmd_options for flag in args] + positionals
+        values = []
+        for args, takes_value, choices, _ in cmd_options:
+            if takes_value:
+                reply = ""
+                if choices:
+                    words_ = shlex.quote(" ".join(choices))
+                    reply = f'COMPREPLY=($(compgen -W {words_} -- "$cur")); '
+                values.append(f"                {'|'.join(args)}) {reply}return;;")
+        options.append(
+            f"        {index})\n"
+            f'            case "$prev" in\n'
+            + "".join(value + "\n" for value in values)
+            + f"            esac\n"
+            f"            words={shlex.quote(' '.join(words + [names]))};;"
+        )
+    return BASH_COMPLETION.format(
+        func=func,
+        prog=shlex.quote(prog),
+        names=shlex.quote(names),
+        commands="\n".join(cases),
+        options="\n".join(options),
+    )
+
+
+def fish_completion(prog, commands):
+    import shlex
+
+    prog = shlex.quote(prog)
+    lines = []
+    for cmd_names, help, options, positionals in commands:
+        for name in cmd_names:
+            line = f"complete -c {prog} -a {shlex.quote(name)}"
+            if help:
+                line += f" -d {shlex.quote(help.splitlines()[0])}"
+            lines.append(line)
+        seen = "__fish_seen_subcommand_from " + " ".join(
+            shlex.quote(name) for name in cmd_names
+        )
+        if positionals:
+            lines.append(
+                f"complete -c {prog} -n {shlex.quote(seen)}"
+                f" -a {shlex.quote(' '.join(positionals))}"
+            )
+        for args, takes_value, choices, help in options:
+            line = f"complete -c {prog} -n {shlex.quote(seen)}"
+            for flag in args:
+                line += (
+                    f" -l {flag[2:]}" if flag.startswith("--") else f" -s {flag[1:]}"
+                )
+            if help:
+                line += f" -d {shlex.quote(help)}"
+            if choices:
+                line += f" -xa {shlex.quote(' '.join(choices))}"
+            elif takes_value:
+                line += " -r"
+            lines.append(line)
+    return "\n".join(lines) + "\n"
 
 
 def command(*args, **kwargs):
@@ -179,45 +2295,85 @@ def command(*args, **kwargs):
     return run(*args, **kwargs)
 
 
-def wrap(func):
-    if not (inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func)):
-        raise ValueError(f'"{func}" needs to yield')
-    _wrapper_functions.append(func)
-    return func
+def compile_plan(spec):
+    """Return the (name, slot) binding plan of the `spec` signature.
+
+    Computed once per command and wrapper, so binding values at each call
+    does not need to inspect parameters again.
+    """
+    plan = []
+    for name, parameter in spec.parameters.items():
+        if parameter.kind == parameter.VAR_POSITIONAL:
+            plan.append((name, VARARGS))
+        elif parameter.default == NO_DEFAULT:
+            plan.append((name, ARG))
+        else:
+            plan.append((name, KWARG))
+    return tuple(plan)
 
 
-def call_wrappers():
-    for wrapper in _wrapper_generators:
+def bind(plan, values):
+    """Return the args and kwargs of `plan`, taken from the `values` dict."""
+    args = []
+    kwargs = {}
+    for name, slot in plan:
+        value = values.get(name)
+        if slot is ARG:
+            args.append(value)
+        elif slot is KWARG:
+            kwargs[name] = value
+        else:
+            args.extend(value)
+    return args, kwargs
+
+
+def call_wrappers(generators):
+    """Resume the wrapper `generators`, return the yielded values by name of
+    the parameter they provide."""
+    resources = {}
+    for provides, wrapper in generators:
         try:
-            if inspect.isasyncgen(wrapper):
-                fut = wrapper.__anext__()
-                asyncio.get_event_loop().run_until_complete(fut)
-            else:
-                next(wrapper)
+            with profile("wrapper", wrapper=wrapper.__name__), measure(
+                "wrapper", wrapper.__name__, generator=wrapper
+            ):
+                if inspect.isasyncgen(wrapper):
+                    value = run_async(wrapper.__anext__())
+                else:
+                    value = next(wrapper)
         except (StopIteration, StopAsyncIteration):
             pass
+        else:
+            if provides:
+                resources[provides] = value
+    return resources
 
 
 def prepare_wrappers(**shared):
-    for func in _wrapper_functions:
-        spec = inspect.signature(func)
-        kwargs = {}
-        args = []
-        for name, parameter in spec.parameters.items():
-            value = shared.get(name)
-            if parameter.kind == parameter.VAR_POSITIONAL:
-                args.extend(value)
-            elif parameter.default == NO_DEFAULT:
-                args.append(value)
-            else:
-                kwargs[name] = value
+    """Return the wrapper generators of the run, for call_wrappers."""
+    with profile("prepare_wrappers"):
+        return _prepare_wrappers(current_app().wrappers, shared)
+
+
+def _prepare_wrappers(wrappers, shared):
+    generators = []
+    for func in wrappers:
+        args, kwargs = bind(func._plan, shared)
         # Execute each wrapper to get the generator.
-        _wrapper_generators.append(func(*args, **kwargs))
+        generators.append((func._provides, func(*args, **kwargs)))
+    return generators
 
 
 def make_argument(arg_name, default=NO_DEFAULT, **kwargs):
     name = kwargs.pop("name", arg_name)
     args = [name]
+    typecode = array_typecode(kwargs.get("type"))
+    if typecode and default is not NARGS and "action" not in kwargs:
+        # Converted in one pass by the parser, see ArrayAction: no type.
+        kwargs.update(type=None, action="array", typecode=typecode, nargs="+")
+        if isinstance(default, (list, tuple)):
+            import array
+
+            default = array.array(typecode, default)
     if default not in (NO_DEFAULT, NARGS):
         if "_" not in name and name[0] != "h":
             args.append("-{}".format(name[0]))
@@ -234,7 +2390,11 @@ def make_argument(arg_name, default=NO_DEFAULT, **kwargs):
             if nargs:
                 kwargs["nargs"] = nargs
         elif callable(type_):
-            if isinstance(typing.get_origin(type_), typing._SpecialForm):
+            # No need to import typing if the commands did not.
+            typing = sys.modules.get("typing")
+            if typing and isinstance(
+                getattr(type_, "__origin__", None), typing._SpecialForm
+            ):
                 # May be typing.Optional, or typing.Union, Any…, we don't know what
                 # to do with that
                 pass
@@ -246,3 +2406,24 @@ def make_argument(arg_name, default=NO_DEFAULT, **kwargs):
     elif default == NARGS:
         kwargs["nargs"] = "*"
     return args, kwargs
+
+
+def array_typecode(type_):
+    """Return the array typecode of a numeric sequence type (list[int],
+    list[float], array.array), None for any other type."""
+    if getattr(type_, "__origin__", None) is list:
+        return ARRAY_TYPECODES.get(type_.__args__)
+    if getattr(type_, "__module__", None) == "array" and type_.__name__ == "array":
+        return "d"
+    return None
+
+
+if os.environ.get("MINICLI_PROFILE"):
+    # Enabled from the environment to also profile the commands import.
+    from .profiler import Profiler
+
+    _profiler = Profiler(
+        os.environ["MINICLI_PROFILE"],
+        bool(os.environ.get("MINICLI_PROFILE_MEMORY")),
+        os.environ.get("MINICLI_PROFILE_CPROFILE"),
+    )
@@ -0,0 +1,212 @@
+"""Disk cache of the commands output, see the cache option of minicli.cli."""
+
+import contextlib
+import contextvars
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+from . import current_app, dump_json, stat_source
+
+# What the cached calls of the current context write, see capture.
+_captured = contextvars.ContextVar("minicli_captured", default=None)
+_lock = threading.Lock()
+_tee = None
+_users = 0
+
+
+class Tee:
+    """Stream writing to `stream`, and keeping what the cached call of the
+    current context writes."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        chunks = _captured.get()
+        if chunks is not None:
+            chunks.append(text)
+        return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextlib.contextmanager
+def capture():
+    """Yield the list of what is written to sys.stdout from the current
+    context while in this block. Concurrent blocks share the same Tee."""
+    global _tee, _users
+    with _lock:
+        if not _users:
+            _tee = sys.stdout = Tee(sys.stdout)
+        _users += 1
+    chunks = []
+    token = _captured.set(chunks)
+    try:
+        yield chunks
+    finally:
+        _captured.reset(token)
+        with _lock:
+            _users -= 1
+            if not _users and sys.stdout is _tee:
+                sys.stdout = _tee.stream
+
+
+def cached_call(cmd, command, shared, refresh=False):
+    """Replay the output and exit status stored for `command` (parsed
+    arguments of `cmd`), or run it and store them, see cached."""
+    with cached(cmd, command, shared, refresh) as run:
+        if run:
+            command.func(command, **shared)
+
+
+@contextlib.contextmanager
+def cached(cmd, command, shared, refresh=False):
+    """Replay the output and exit status stored for `command` (parsed
+    arguments of `cmd`) and yield False, or yield True: the command is to be
+    run in this block, its output and exit status are then stored.
+
+    With `refresh`, the command is run and its entry replaced. A command
+    streaming values from stdin is always run.
+    """
+    values = {**vars(command), **shared}
+    if streamed_files(cmd, values) is None:
+        yield True
+        return
+    settings = current_app().settings
+    directory = settings["cache_dir"] or default_directory()
+    path = os.path.join(directory, cache_key(cmd, values))
+    if not refresh:
+        entry = read_entry(path)
+        if entry is not None:
+            sys.stdout.write(entry["output"])
+            if entry["status"]:
+                sys.exit(entry["status"])
+            yield False
+            return
+    status = None
+    with capture() as chunks:
+        try:
+            yield True
+            status = 0
+        except SystemExit as err:
+            if err.code is None or isinstance(err.code, (int, str)):
+                status = err.code or 0
+            raise
+        finally:
+            if status is not None:
+                ttl = cmd.cache if cmd.cache is not True else None
+                entry = {
+                    "output": "".join(chunks),
+                    "status": status,
+                    "expires": time.time() + ttl if ttl else None,
+                }
+                os.makedirs(directory, exist_ok=True)
+                dump_json(path, entry)
+                evict(directory, settings["cache_size"])
+
+
+def default_directory():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "minicli")
+
+
+def cache_key(cmd, values):
+    """Return the entry name of `cmd` called with its arguments `values`:
+    the command and the state of its source file, its command line arguments,
+    and the fingerprint of their paths and streamed files."""
+    func = cmd.command
+    code = getattr(func, "__code__", None)
+    arguments = [(name, values.get(name)) for name, _ in cmd.arguments()]
+    key = [
+        code.co_filename if code else func.__module__,
+        source(func),
+        func.__qualname__,
+        arguments,
+        [fingerprint(path) for path in paths(arguments)],
+        [fingerprint(path) for path in streamed_files(cmd, values)],
+    ]
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def source(func):
+    """Return the modification time and size of the file defining `func`, so
+    that its entries are not used once its code changed."""
+    code = getattr(func, "__code__", None)
+    module = sys.modules.get(func.__module__)
+    path = code.co_filename if code else getattr(module, "__file__", None)
+    try:
+        return stat_source(path)
+    except (OSError, TypeError):
+        return None  # Not from a file (REPL, exec…).
+
+
+def streamed_files(cmd, values):
+    """Return the `@file` paths read by the streamed parameters of `cmd`, or
+    None if one of them reads stdin."""
+    files = []
+    for name, _ in cmd.streamed:
+        for value in values.get(name) or ():
+            if value == "-":
+                return None
+            if isinstance(value, str) and value.startswith("@"):
+                files.append(value[1:])
+    return files
+
+
+def paths(values):
+    for _, value in values:
+        if isinstance(value, os.PathLike):
+            yield value
+        elif isinstance(value, (list, tuple)):
+            yield from (item for item in value if isinstance(item, os.PathLike))
+
+
+def fingerprint(path, size=1 << 20):
+    """Return the mtime, size and content hash of the file at `path`."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    digest = hashlib.sha1()
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(size), b""):
+                digest.update(chunk)
+    return [stat.st_mtime_ns, stat.st_size, digest.hexdigest()]
+
+
+def read_entry(path):
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        if entry["expires"] is not None and entry["expires"] < time.time():
+            os.unlink(path)
+            return None
+        os.utime(path)  # Recently used, see evict.
+    except FileNotFoundError:
+        return None  # Evicted by another process.
+    return entry
+
+
+def evict(directory, size):
+    """Remove the least recently used entries, until they take at most
+    `size` bytes."""
+    with os.scandir(directory) as scan:
+        entries = [(entry.stat().st_mtime_ns, entry) for entry in scan]
+    total = sum(entry.stat().st_size for _, entry in entries)
+    for _, entry in sorted(entries, key=lambda item: item[0]):
+        if total <= size:
+            break
+        total -= entry.stat().st_size
+        try:
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            pass  # Evicted by another process.
@@ -0,0 +1,67 @@
+"""Thin client running a command line on a minicli server, see minicli.serve.
+
+    python -m minicli.client SOCKET [ARGS…]
+
+The current directory, environment and standard streams are forwarded to the
+server, and the exit status of the command is returned.
+"""
+
+import array
+import json
+import os
+import socket
+import struct
+import sys
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+def send_fds(sock, data, fds):
+    """Send `data` along with the file descriptors `fds` (socket.send_fds
+    needs Python 3.9)."""
+    rights = (socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))
+    return sock.sendmsg([data], [rights])
+
+
+def recv_fds(sock, size, maxfds):
+    """Receive up to `size` bytes and `maxfds` file descriptors, see
+    send_fds."""
+    fds = array.array("i")
+    space = socket.CMSG_LEN(maxfds * fds.itemsize)
+    data, ancillary, _, _ = sock.recvmsg(size, space)
+    for level, kind, payload in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[: len(payload) - len(payload) % fds.itemsize])
+    return data, list(fds)
+
+
+def call(path, argv):
+    request = {"argv": argv, "cwd": os.getcwd(), "env": dict(os.environ)}
+    request = json.dumps(request).encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        send_fds(sock, struct.pack("!I", len(request)), [0, 1, 2])
+        sock.sendall(request)
+        return struct.unpack("!i", recv_exactly(sock, 4))[0]
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(f"Usage: {sys.argv[0]} SOCKET [ARGS…]")
+    try:
+        status = call(sys.argv[1], sys.argv[2:])
+    except (OSError, ConnectionError) as err:
+        sys.exit(f"minicli server error: {err}")
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""Runtime metrics of the commands and wrappers, see minicli.measure."""
+
+import atexit
+import json
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+
+try:
+    import resource
+except ImportError:  # Windows.
+    resource = None
+
+# Recorder of each sink, see recorder.
+_recorders = {}
+_lock = threading.Lock()
+# Wrapper generators already resumed once: the next phase is the teardown.
+_started = weakref.WeakSet()
+
+
+class JsonLinesSink:
+    """Append each record as a JSON document line to the file at `path`."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, records):
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        with open(self.path, "a") as f:
+            f.write(lines)
+
+
+class StatsdSink:
+    """Send the records in the statsd format, over UDP to `host`:`port`.
+
+    Durations are sent as timers (in milliseconds), the maximum RSS and
+    traced memory peak as gauges, the exit status and exception as counters.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8125, prefix="minicli", size=1400):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.size = size
+        self.socket = None
+
+    def __call__(self, records):
+        if self.socket is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        packet = b""
+        for record in records:
+            for line in self.lines(record):
+                line = line.encode()
+                if packet and len(packet) + len(line) >= self.size:
+                    self.socket.sendto(packet, self.address)
+                    packet = b""
+                packet += line + b"\n"
+        if packet:
+            self.socket.sendto(packet, self.address)
+
+    def lines(self, record):
+        name = f"{self.prefix}.{record['kind']}.{record['name']}"
+        if "phase" in record:
+            name += f".{record['phase']}"
+        yield f"{name}.wall:{record['wall'] * 1000:.3f}|ms"
+        yield f"{name}.cpu:{record['cpu'] * 1000:.3f}|ms"
+        for key in ("max_rss", "memory_peak"):
+            if record.get(key) is not None:
+                yield f"{name}.{key}:{record[key]}|g"
+        yield f"{name}.status.{record['status']}:1|c"
+        if record["exception"]:
+            yield f"{name}.exception.{record['exception']}:1|c"
+
+
+class Recorder:
+    """Queue the records, sent to `sink` by batches of at most `batch`
+    records from a background thread: measuring does not wait for the
+    sink."""
+
+    def __init__(self, sink, batch=512):
+        self.sink = sink
+        self.batch = batch
+        self.queue = queue.SimpleQueue()
+        self.pid = None
+        self.thread = None
+
+    def measure(self, kind, name, generator=None):
+        """Return the context manager measuring the `name` command or
+        wrapper; the phase of a wrapper is told by its `generator`."""
+        meta = {}
+        if generator is not None:
+            meta["phase"] = "teardown" if generator in _started else "setup"
+            _started.add(generator)
+        return Measure(self, kind, name, meta)
+
+    def add(self, record):
+        if self.pid != os.getpid():  # First record, or forked process.
+            self.start()
+        self.queue.put(record)
+
+    def start(self):
+        with _lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = queue.SimpleQueue()  # Shared with the parent.
+            self.thread = threading.Thread(
+                target=self.send, name="minicli-metrics", daemon=True
+            )
+            self.thread.start()
+
+    def send(self):
+        stopping = False
+        while not stopping:
+            records = [self.queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            flushed = [record for record in records if isinstance(record, Flush)]
+            records = [record for record in records if isinstance(record, dict)]
+            try:
+                if records:
+                    self.sink(records)
+            except Exception as err:
+                print(f"Metrics not sent: {err!r}", file=sys.stderr)
+            for flush in flushed:
+                stopping = stopping or flush.stop
+                flush.done.set()
+
+    def flush(self, timeout=5, stop=True):
+        """Wait until the queued records are sent, at most `timeout`
+        seconds; stop the background thread if `stop`."""
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            return
+        flush = Flush(threading.Event(), stop)
+        self.queue.put(flush)
+        flush.done.wait(timeout)
+        if stop:
+            self.pid = None
+
+
+class Flush:
+    """Queue item set once the records queued before it are sent."""
+
+    __slots__ = ("done", "stop")
+
+    def __init__(self, done, stop):
+        self.done = done
+        self.stop = stop
+
+
+class Measure:
+    """Record the wall time, CPU time, memory, exit status and exception of
+    the block."""
+
+    __slots__ = ("recorder", "kind", "name", "meta", "start", "cpu")
+
+    def __init__(self, recorder, kind, name, meta):
+        self.recorder = recorder
+        self.kind = kind
+        self.name = name
+        self.meta = meta
+
+    def __enter__(self):
+        if traced():
+            tracemalloc.reset_peak()
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+
+    def __exit__(self, type_, err, traceback):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        status, exception = 0, None
+        if isinstance(err, SystemExit):
+            if err.code is not None:
+                status = err.code if isinstance(err.code, int) else 1
+        elif err is not None and not isinstance(
+            err, (StopIteration, StopAsyncIteration)
+        ):
+            status, exception = 1, type_.__name__
+        self.recorder.add(
+            {
+                "kind": self.kind,
+                "name": self.name,
+                **self.meta,
+                "time": time.time() - wall,
+                "wall": wall,
+                "cpu": cpu,
+                "max_rss": max_rss(),
+                "memory_peak": tracemalloc.get_traced_memory()[1] if traced() else None,
+                "status": status,
+                "exception": exception,
+            }
+        )
+
+
+def traced():
+    """Tell if the memory peak of a block can be measured."""
+    # tracemalloc.reset_peak is new in Python 3.9.
+    return tracemalloc.is_tracing() and hasattr(tracemalloc, "reset_peak")
+
+
+def max_rss():
+    """Return the maximum resident set size of the process, in KiB."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def recorder(sink):
+    """Return the Recorder of `sink`, created on first use."""
+    if sink not in _recorders:
+        _recorders[sink] = Recorder(sink)
+        atexit.register(_recorders[sink].flush)
+    return _recorders[sink]
+
+
+def flush(timeout=5):
+    """Wait until the queued records of every sink are sent."""
+    for item in list(_recorders.values()):
+        item.flush(timeout, stop=False)
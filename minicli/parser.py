@@ -0,0 +1,57 @@
+"""Argparse parser of minicli, only imported when a parser is built."""
+
+import argparse
+import array
+
+from . import ChainError, _parsing
+
+INTEGER_TYPECODES = "bBhHiIlLqQ"
+
+
+class Parser(argparse.ArgumentParser):
+    """Parser raising ChainError instead of exiting when parsing a chain."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.register("action", "array", ArrayAction)
+
+    def error(self, message):
+        if getattr(_parsing, "quiet", False):
+            raise ChainError(message)
+        super().error(message)
+
+
+class ArrayAction(argparse.Action):
+    """Store the values in an array.array of `typecode`, converted in one
+    pass. Each occurrence of an option extends the array."""
+
+    def __init__(self, option_strings, dest, typecode="d", **kwargs):
+        self.typecode = typecode
+        self.convert = int if typecode in INTEGER_TYPECODES else float
+        super().__init__(option_strings, dest, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        try:
+            items = array.array(self.typecode, map(self.convert, values))
+        except (ValueError, OverflowError):
+            raise argparse.ArgumentError(self, self.invalid(values))
+        current = getattr(namespace, self.dest, None)
+        if isinstance(current, array.array) and current is not self.default:
+            current.extend(items)
+        else:
+            setattr(namespace, self.dest, items)
+
+    def invalid(self, values):
+        """Return the error message for the first malformed value."""
+        for position, value in enumerate(values, 1):
+            try:
+                array.array(self.typecode, [self.convert(value)])
+            except ValueError:
+                reason = "invalid"
+            except OverflowError:
+                reason = "out of range"
+            else:
+                continue
+            name = self.convert.__name__
+            return f"{reason} {name} value: {value!r} (value {position})"
+        return "invalid values"
@@ -0,0 +1,66 @@
+"""Phases profiler of minicli runs, see minicli.profile."""
+
+import contextlib
+import cProfile
+import json
+import sys
+import time
+import tracemalloc
+
+
+class Profiler:
+    """Record the duration of each phase of a run, see profile()."""
+
+    def __init__(self, output="-", memory=False, cprofile=None):
+        self.output = output
+        self.memory = memory
+        self.phases = []
+        self.active = False
+        self.started = time.perf_counter()
+        if memory:
+            tracemalloc.start()
+        self.cprofile = cprofile and cProfile.Profile()
+        if self.cprofile:
+            self.cprofile_output = cprofile
+            self.cprofile.enable()
+
+    @contextlib.contextmanager
+    def phase(self, name, **meta):
+        record = self.mark(name, **meta)
+        if self.memory and hasattr(tracemalloc, "reset_peak"):  # Python 3.9+.
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            record["duration"] = time.perf_counter() - self.started - record["start"]
+            if self.memory:
+                record["memory_peak"] = tracemalloc.get_traced_memory()[1]
+
+    def mark(self, name, **meta):
+        record = {"phase": name, **meta, "start": time.perf_counter() - self.started}
+        self.phases.append(record)
+        return record
+
+    def stop(self):
+        report = {"total": time.perf_counter() - self.started, "phases": self.phases}
+        summary = report["summary"] = {}
+        for record in self.phases:
+            summary[record["phase"]] = summary.get(record["phase"], 0) + record.get(
+                "duration", 0
+            )
+        if self.memory:
+            report["memory_peak"] = max(
+                [tracemalloc.get_traced_memory()[1]]
+                + [record.get("memory_peak", 0) for record in self.phases]
+            )
+            tracemalloc.stop()
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.cprofile_output)
+            report["cprofile"] = self.cprofile_output
+        if self.output == "-":
+            json.dump(report, sys.stderr, indent=2)
+            sys.stderr.write("\n")
+        else:
+            with open(self.output, "w") as f:
+                json.dump(report, f, indent=2)
@@ -0,0 +1,77 @@
+"""Server running command lines in forked processes, see minicli.serve."""
+
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import time
+import traceback
+
+from .client import recv_exactly, recv_fds
+
+
+class Handler(socketserver.BaseRequestHandler):
+    """Run a command line sent by minicli.client, in a forked process."""
+
+    def handle(self):
+        # The client sends its stdin, stdout and stderr along with the size
+        # of the request, then the request itself.
+        data, fds = recv_fds(self.request, 4, 3)
+        request = json.loads(recv_exactly(self.request, struct.unpack("!I", data)[0]))
+        for fd, target in zip(fds, (0, 1, 2)):
+            os.dup2(fd, target)
+            os.close(fd)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv[1:] = request["argv"]
+        status = 0
+        try:
+            self.server.app.run(*request["argv"], **self.server.shared)
+        except SystemExit as err:
+            status = err.code if isinstance(err.code, int) else 1
+            if err.code is not None and not isinstance(err.code, int):
+                print(err.code, file=sys.stderr)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            if "minicli.metrics" in sys.modules:
+                # Forked handlers exit without running the atexit functions.
+                sys.modules["minicli.metrics"].flush()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        self.request.sendall(struct.pack("!i", status))
+
+
+class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    def __init__(self, path, idle_timeout, app, shared):
+        self.app = app
+        self.shared = shared
+        self.timeout = idle_timeout
+        self.last_request = time.monotonic()
+        if os.path.exists(path):
+            os.unlink(path)
+        umask = os.umask(0o177)  # Only the current user can connect.
+        try:
+            super().__init__(path, Handler)
+        finally:
+            os.umask(umask)
+
+    def verify_request(self, request, client_address):
+        self.last_request = time.monotonic()
+        if hasattr(socket, "SO_PEERCRED"):
+            creds = request.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+            )
+            return struct.unpack("3i", creds)[1] == os.getuid()
+        return True
+
+    @property
+    def idle(self):
+        self.collect_children()
+        if self.active_children:
+            return False
+        return time.monotonic() - self.last_request >= self.timeout
@@ -1,7 +1,9 @@
-from minicli import _registry, _wrapper_functions, _wrapper_generators
+from minicli import SETTINGS, _help, _registry, _settings, _wrapper_functions
 
 
 def pytest_runtest_teardown():
     _registry.clear()
+    _help.clear()
     _wrapper_functions.clear()
-    _wrapper_generators.clear()
+    _settings.clear()
+    _settings.update(SETTINGS)
@@ -1,10 +1,32 @@
 import asyncio
+import importlib
+import concurrent.futures
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
 from pathlib import Path
-from typing import Union, Optional
+from typing import List, Union, Optional
 
 import pytest
 
-from minicli import cli, run, wrap
+import minicli
+from minicli import (
+    App,
+    _registry,
+    cli,
+    completion,
+    configure,
+    lazy,
+    run,
+    run_batch,
+    wrap,
+)
+from minicli.parser import Parser
 
 
 def test_simple_arg_is_a_required_string(capsys):
@@ -589,3 +611,1940 @@ def test_typing_should_not_interfere(capsys):
     run("command_with_union", "--name", "Jack")
     out, err = capsys.readouterr()
     assert "Hi Jack!" in out
+
+
+def test_only_invoked_command_parser_is_built(capsys):
+    @cli
+    def mycommand(param):
+        print("Param is", param)
+
+    @cli
+    def myothercommand(param):
+        print("Other command param is", param)
+
+    run("mycommand", "myparam")
+    out, err = capsys.readouterr()
+    assert "Param is myparam" in out
+    assert hasattr(mycommand._cli, "parser")
+    assert not hasattr(myothercommand._cli, "parser")
+
+
+def test_chained_commands_parsers_are_built(capsys):
+    @cli
+    def mycommand(param):
+        print("Param is", param)
+
+    @cli
+    def my_other_command(param):
+        print("Other command param is", param)
+
+    @cli
+    def unused(param):
+        pass
+
+    run("mycommand", "myparam", "my_other_command", "otherparam")
+    out, err = capsys.readouterr()
+    assert "Param is myparam" in out
+    assert "Other command param is otherparam" in out
+    assert not hasattr(unused._cli, "parser")
+
+
+def test_all_parsers_are_built_for_help_and_unknown_command(capsys):
+    @cli
+    def mycommand(param):
+        """This is command doc"""
+
+    @cli
+    def myothercommand(param):
+        """This is other command doc"""
+
+    with pytest.raises(SystemExit):
+        run("--help")
+    out, err = capsys.readouterr()
+    assert "This is command doc" in out
+    assert "This is other command doc" in out
+
+    with pytest.raises(SystemExit):
+        run("unknown")
+    out, err = capsys.readouterr()
+    assert "invalid choice: 'unknown'" in err
+    assert "mycommand" in err
+    assert "myothercommand" in err
+
+
+def test_all_parsers_are_built_for_errors_in_a_chain(capsys):
+    @cli
+    def alpha(param):
+        """This is alpha doc"""
+
+    @cli
+    def beta():
+        """This is beta doc"""
+
+    @cli
+    def gamma():
+        """This is gamma doc"""
+
+    with pytest.raises(SystemExit):
+        run("alpha", "1", "unknown")
+    out, err = capsys.readouterr()
+    choices = err.split("invalid choice: 'unknown'")[1]
+    assert "alpha" in choices and "beta" in choices and "gamma" in choices
+
+    with pytest.raises(SystemExit):
+        run("beta", "--unknown")
+    out, err = capsys.readouterr()
+    assert "This is alpha doc" in out
+    assert "This is beta doc" in out
+    assert "This is gamma doc" in out
+
+
+def test_commands_are_listed_in_registration_order(capsys):
+    def make_app():
+        app = App()
+
+        @app.cli
+        def alpha():
+            """This is alpha doc"""
+
+        @app.cli
+        def beta():
+            """This is beta doc"""
+
+        @app.cli(name="gamma-cmd", aliases=["gamma"])
+        def gamma():
+            """This is gamma doc"""
+
+        return app
+
+    def output(app, *args):
+        with pytest.raises(SystemExit):
+            app.run(*args)
+        return capsys.readouterr()
+
+    # All the commands are added at once.
+    cold_error = output(make_app(), "unknown").err.splitlines()[-1]
+    cold_help = output(make_app(), "--help").out
+    assert "alpha, beta, gamma-cmd, gamma" in cold_error.replace("'", "")
+    for args in (["gamma"], ["beta", "alpha"]):
+        app = make_app()
+        app.run(*args)  # Warm process: the invoked commands are added first.
+        assert output(app, *args, "unknown").err.splitlines()[-1] == cold_error
+        assert output(app, "--help").out == cold_help
+        app = make_app()
+        assert output(app, *args, "--unknown").out == cold_help
+
+
+@pytest.fixture
+def commands_module(tmp_path, monkeypatch):
+    def make(name, source):
+        (tmp_path / f"{name}.py").write_text(source)
+        monkeypatch.syspath_prepend(str(tmp_path))
+        monkeypatch.delitem(sys.modules, name, raising=False)
+        return name
+
+    return make
+
+
+def test_lazy_command_is_imported_only_when_invoked(capsys, commands_module):
+    commands_module(
+        "lazycommands",
+        "def deploy_all(target, force=False):\n"
+        '    """Deploy everything.\\n\\n    :target: where to deploy\\n    """\n'
+        "    print('Deploying to', target, force)\n",
+    )
+    lazy("lazycommands:deploy_all", help="Deploy everything")
+
+    with pytest.raises(SystemExit):
+        run("--help")
+    out, err = capsys.readouterr()
+    assert "deploy-all" in out
+    assert "Deploy everything" in out
+    assert "lazycommands" not in sys.modules
+
+    run("deploy-all", "prod", "--force")
+    out, err = capsys.readouterr()
+    assert "Deploying to prod True" in out
+    assert "lazycommands" in sys.modules
+
+
+def test_lazy_command_help_imports_it(capsys, commands_module):
+    commands_module(
+        "lazycommands",
+        "def deploy(target):\n"
+        '    """Deploy.\\n\\n    :target: where to deploy\\n    """\n',
+    )
+    lazy("lazycommands:deploy", name="ship", help="Deploy")
+
+    with pytest.raises(SystemExit):
+        run("ship", "--help")
+    out, err = capsys.readouterr()
+    assert "where to deploy" in out
+
+
+def test_lazy_command_can_be_decorated_in_its_module(capsys, commands_module):
+    commands_module(
+        "lazycommands",
+        "from minicli import cli\n\n"
+        "@cli('target', choices=['prod', 'staging'])\n"
+        "def deploy(target):\n"
+        "    print('Deploying to', target)\n",
+    )
+    lazy("lazycommands:deploy", help="Deploy")
+
+    run("deploy", "prod")
+    out, err = capsys.readouterr()
+    assert "Deploying to prod" in out
+    assert len(_registry) == 1
+
+    with pytest.raises(SystemExit):
+        run("deploy", "dev")
+    out, err = capsys.readouterr()
+    assert "invalid choice: 'dev'" in err
+
+
+def test_manifest_defines_lazy_commands_without_import(
+    capsys, commands_module, tmp_path
+):
+    name = commands_module(
+        "lazycommands",
+        "from pathlib import Path\n\n"
+        "def deploy(target: Path, retries=3):\n"
+        '    """Deploy.\\n\\n    :target: where to deploy\\n    """\n'
+        "    print('Deploying to', target, retries)\n",
+    )
+    manifest = tmp_path / "manifest.json"
+    configure(manifest=str(manifest))
+    lazy("lazycommands:deploy", help="Deploy")
+    run("deploy", "prod")  # Builds the manifest.
+    out, err = capsys.readouterr()
+    assert "Deploying to prod 3" in out
+    assert manifest.exists()
+
+    # New process.
+    _registry.clear()
+    del sys.modules[name]
+    lazy("lazycommands:deploy", help="Deploy")
+    with pytest.raises(SystemExit):
+        run("deploy", "--help")
+    out, err = capsys.readouterr()
+    assert "where to deploy" in out
+    assert "--retries" in out
+    assert name not in sys.modules
+
+    run("deploy", "prod", "--retries", "5")
+    out, err = capsys.readouterr()
+    assert "Deploying to prod 5" in out
+
+
+def test_stale_manifest_is_rebuilt(capsys, commands_module, tmp_path):
+    source = "def deploy(target{}):\n    print('Deploying to', target)\n"
+    name = commands_module("lazycommands", source.format(""))
+    manifest = tmp_path / "manifest.json"
+    configure(manifest=str(manifest))
+    lazy("lazycommands:deploy", help="Deploy")
+    run("deploy", "prod")
+    capsys.readouterr()
+
+    _registry.clear()
+    del sys.modules[name]
+    commands_module("lazycommands", source.format(", dry_run=False"))
+    lazy("lazycommands:deploy", help="Deploy")
+    with pytest.raises(SystemExit):
+        run("deploy", "--help")
+    out, err = capsys.readouterr()
+    assert "--dry-run" in out
+    assert "dry_run" in manifest.read_text()
+
+
+def test_configure_rejects_unknown_settings():
+    with pytest.raises(TypeError):
+        configure(unknown=True)
+
+
+def test_bash_completion(tmp_path):
+    @cli("speed", choices=[1, 2])
+    @cli("direction", choices=["top", "down"])
+    def go_to(direction, speed: int = 1, fast=False):
+        pass
+
+    @cli
+    def other(*paths):
+        pass
+
+    script = tmp_path / "completion.sh"
+    script.write_text(completion("bash", prog="my-cli"))
+
+    def complete(*words):
+        if not shutil.which("bash"):
+            pytest.skip("bash is not available")
+        return subprocess.run(
+            [
+                "bash",
+                "-c",
+                f'source {script}; COMP_WORDS=("$@"); '
+                "COMP_CWORD=$((${#COMP_WORDS[@]}-1)); "
+                '_minicli_my_cli; echo "${COMPREPLY[*]}"',
+                "bash",
+                *words,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+
+    assert complete("my-cli", "") == ["go-to", "go_to", "other"]
+    assert complete("my-cli", "go_to", "--sp") == ["--speed"]
+    assert complete("my-cli", "go-to", "--speed", "") == ["1", "2"]
+    assert complete("my-cli", "go-to", "d") == ["down"]
+    assert complete("my-cli", "go-to", "top", "ot") == ["other"]
+
+
+def test_fish_and_zsh_completion():
+    @cli("direction", choices=["top", "down"])
+    def go_to(direction, fast=False):
+        """Go somewhere."""
+
+    script = completion("fish", prog="my-cli")
+    assert "complete -c my-cli -a go-to -d 'Go somewhere.'" in script
+    assert "complete -c my-cli -a go_to -d 'Go somewhere.'" in script
+    assert "-a 'top down'" in script
+    assert "-l fast -s f" in script
+
+    script = completion("zsh", prog="my-cli")
+    assert script.startswith("autoload -U +X bashcompinit && bashcompinit")
+    assert "complete -o default -F _minicli_my_cli my-cli" in script
+
+    with pytest.raises(ValueError):
+        completion("powershell")
+
+
+def test_async_commands_and_wrappers_share_one_loop(capsys):
+    loops = []
+
+    @cli
+    async def mycommand():
+        loops.append(asyncio.get_running_loop())
+
+    @cli
+    async def myothercommand():
+        loops.append(asyncio.get_running_loop())
+
+    @wrap
+    async def my_wrapper():
+        loops.append(asyncio.get_running_loop())
+        yield
+        loops.append(asyncio.get_running_loop())
+
+    run("mycommand", "myothercommand")
+    assert len(loops) == 4
+    assert len(set(loops)) == 1
+    assert loops[0].is_closed()
+
+
+def test_async_generators_are_finalized_with_the_loop(capsys):
+    @cli
+    async def mycommand():
+        async def numbers():
+            try:
+                yield 1
+                yield 2
+            finally:
+                print("finalized")
+
+        # Never exhausted: must be closed when shutting down the loop.
+        mycommand.numbers = numbers()
+        await mycommand.numbers.__anext__()
+
+    run("mycommand")
+    out, err = capsys.readouterr()
+    assert "finalized" in out
+
+
+def test_can_set_event_loop_factory(capsys):
+    loops = []
+
+    def factory():
+        loop = asyncio.new_event_loop()
+        loops.append(loop)
+        return loop
+
+    configure(loop_factory=factory)
+
+    @cli
+    async def mycommand():
+        assert asyncio.get_running_loop() is loops[0]
+
+    @cli
+    def mysynccommand():
+        pass
+
+    run("mysynccommand")
+    assert not loops  # Only created when needed.
+    run("mycommand", "mycommand")
+    assert len(loops) == 1
+
+
+def test_parallel_runs_chained_commands_concurrently(capsys):
+    barrier = threading.Barrier(2, timeout=5)
+
+    @cli
+    def mycommand(param):
+        barrier.wait()  # Would time out if commands were run one by one.
+        print("Param is", param)
+
+    @cli
+    def myothercommand(param):
+        barrier.wait()
+        print("Other command param is", param)
+
+    @wrap
+    def my_wrapper():
+        print("before")
+        yield
+        print("after")
+
+    run("--minicli-parallel", "mycommand", "foo", "myothercommand", "bar")
+    out, err = capsys.readouterr()
+    assert "Param is foo" in out
+    assert "Other command param is bar" in out
+    assert out.startswith("before\n")
+    assert out.endswith("after\n")
+
+
+def test_concurrency_setting_gathers_async_commands(capsys):
+    configure(concurrency=2)
+    event = None
+
+    @cli
+    async def waiter():
+        nonlocal event
+        event = event or asyncio.Event()
+        await asyncio.wait_for(event.wait(), 5)
+        print("waited")
+
+    @cli
+    async def setter():
+        nonlocal event
+        event = event or asyncio.Event()
+        event.set()
+
+    run("waiter", "setter")
+    out, err = capsys.readouterr()
+    assert "waited" in out
+
+
+def test_parallel_failures_are_collected(capsys):
+    @cli
+    def failing():
+        raise ValueError("boom")
+
+    @cli
+    def exiting():
+        sys.exit(3)
+
+    @cli
+    def working():
+        print("working")
+
+    @wrap
+    def my_wrapper():
+        yield
+        print("after")
+
+    with pytest.raises(SystemExit) as excinfo:
+        run("--minicli-parallel", "failing", "exiting", "working")
+    assert excinfo.value.code == 3
+    out, err = capsys.readouterr()
+    assert "working" in out
+    assert "after" in out
+    assert "Command failing failed" in err
+    assert "ValueError: boom" in err
+
+
+def test_builtin_options_do_not_take_commands_options(capsys):
+    @cli
+    def add(x, p: int = 0, b: int = 0, f: int = 0, j: int = 0, n: int = 0, m: int = 0):
+        print("Add", x, p, b, f, j, n, m)
+
+    @cli
+    def export(
+        parallel=False,
+        batch=False,
+        format="json",
+        jobs=1,
+        unordered=False,
+        no_cache=False,
+    ):
+        print("Export", parallel, batch, format, jobs, unordered, no_cache)
+
+    run("add", "1", "--p", "2", "--b", "3", "--f", "4", "--j", "5", "--n=6", "--m", "7")
+    run("export", "--parallel", "--batch", "--format", "xml", "--jobs", "2")
+    run("export", "--unordered", "--no-cache")
+    run("--minicli-parallel", "export", "--parallel")
+    out, err = capsys.readouterr()
+    assert "Add 1 2 3 4 5 6 7" in out
+    assert "Export True True xml 2 False False" in out
+    assert "Export False False json 1 True True" in out
+    assert "Export True False json 1 False False" in out
+
+
+def test_run_batch(capsys):
+    @cli
+    def mycommand(param, optional=False):
+        print("Param is", param, optional)
+
+    @wrap
+    def my_wrapper():
+        print("before")
+        yield
+        print("after")
+
+    run_batch(["mycommand foo", "", "mycommand 'bar baz' --optional"])
+    out, err = capsys.readouterr()
+    assert out == "before\nParam is foo False\nParam is bar baz True\nafter\n"
+    assert "2 lines run, 0 failed" in err
+
+    run_batch(["mycommand foo", "mycommand bar"], wrap_each=True)
+    out, err = capsys.readouterr()
+    assert out.count("before") == 2
+    assert out.count("after") == 2
+
+
+def test_run_batch_isolates_failing_lines(capsys):
+    @cli
+    def mycommand(param: int):
+        if param == 0:
+            raise ValueError("zero")
+        print("Param is", param)
+
+    with pytest.raises(SystemExit) as excinfo:
+        run_batch(["mycommand 1", "mycommand notanint", "mycommand 0", "mycommand 2"])
+    assert excinfo.value.code == 1
+    out, err = capsys.readouterr()
+    assert "Param is 1" in out
+    assert "Param is 2" in out
+    assert "invalid int value: 'notanint'" in err
+    assert "ValueError: zero" in err
+    assert "Line 2 failed: mycommand notanint" in err
+    assert "4 lines run, 2 failed" in err
+
+
+def test_batch_option_reads_file_or_stdin(capsys, tmp_path, monkeypatch):
+    @cli
+    def mycommand(param):
+        print("Param is", param)
+
+    batch = tmp_path / "batch"
+    batch.write_text("mycommand foo\nmycommand bar\n")
+    run("--minicli-batch", str(batch))
+    out, err = capsys.readouterr()
+    assert out == "Param is foo\nParam is bar\n"
+
+    monkeypatch.setattr(sys, "stdin", io.StringIO("mycommand foo\0mycommand bar"))
+    run("--minicli-batch", "-", "--minicli-batch-null")
+    out, err = capsys.readouterr()
+    assert out == "Param is foo\nParam is bar\n"
+
+
+@pytest.fixture
+def server(tmp_path):
+    script = tmp_path / "server.py"
+    script.write_text(
+        "import os, sys\n"
+        "import minicli\n"
+        "from minicli import cli, serve, wrap\n\n"
+        "built = []\n"
+        "init_parser = minicli.Cli.init_parser\n\n"
+        "def spy(self, *args):\n"
+        "    built.append(os.getpid())\n"
+        "    return init_parser(self, *args)\n\n"
+        "minicli.Cli.init_parser = spy\n\n"
+        "@cli\n"
+        "def hello(name, exit: int = 0):\n"
+        "    print('Hello', name, os.getcwd(), os.environ.get('GREETING'))\n"
+        "    print('built here:', os.getpid() in built)\n"
+        "    print('stdin:', sys.stdin.read(), file=sys.stderr)\n"
+        "    sys.exit(exit)\n\n"
+        "calls = []\n\n"
+        "@wrap\n"
+        "def wrapper():\n"
+        "    calls.append(1)\n"
+        "    print('calls:', len(calls))\n"
+        "    yield\n\n"
+        "serve(sys.argv[1], idle_timeout=float(sys.argv[2]))\n"
+    )
+    path = str(tmp_path / "socket")
+    process = None
+
+    def start(idle_timeout=30):
+        nonlocal process
+        process = subprocess.Popen(
+            [sys.executable, str(script), path, str(idle_timeout)]
+        )
+        for _ in range(100):
+            if os.path.exists(path):
+                return process
+            time.sleep(0.05)
+        raise RuntimeError("Server did not start")
+
+    def call(*args, **kwargs):
+        return subprocess.run(
+            [sys.executable, "-m", "minicli.client", path, *args],
+            capture_output=True,
+            text=True,
+            **kwargs,
+        )
+
+    yield start, call
+    if process.poll() is None:
+        process.terminate()
+        process.wait()
+
+
+def test_serve_forwards_cwd_env_streams_and_status(server, tmp_path):
+    start, call = server
+    start()
+    env = dict(os.environ, GREETING="hi")
+    result = call("hello", "world", input="some input", cwd=tmp_path, env=env)
+    assert result.returncode == 0
+    assert f"Hello world {tmp_path} hi" in result.stdout
+    assert "stdin: some input" in result.stderr
+    # Each call is isolated: wrapper state does not leak.
+    assert "calls: 1" in result.stdout
+    # The parsers were built by the server, before forking.
+    assert "built here: False" in result.stdout
+
+    result = call("hello", "world", "--exit", "3", input="")
+    assert result.returncode == 3
+    assert "calls: 1" in result.stdout
+
+    result = call("unknown", input="")
+    assert result.returncode == 2
+    assert "invalid choice: 'unknown'" in result.stderr
+
+
+def test_serve_handles_concurrent_clients(server):
+    start, call = server
+    start()
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda i: call("hello", str(i), input=""), range(8)))
+    for i, result in enumerate(results):
+        assert result.returncode == 0
+        assert f"Hello {i} " in result.stdout
+
+
+def test_serve_stops_when_idle(server):
+    start, call = server
+    process = start(idle_timeout=0.5)
+    assert process.wait(timeout=10) == 0
+
+
+def test_profile_option_reports_phases(capsys, tmp_path):
+    @cli
+    def mycommand(param):
+        print("Param is", param)
+
+    @wrap
+    def my_wrapper():
+        yield
+
+    report = tmp_path / "report.json"
+    cprofile = tmp_path / "report.prof"
+    run(
+        "--minicli-profile",
+        str(report),
+        "--minicli-profile-memory",
+        "--minicli-profile-cprofile",
+        str(cprofile),
+        "mycommand",
+        "foo",
+    )
+    out, err = capsys.readouterr()
+    assert "Param is foo" in out
+    report = json.loads(report.read_text())
+    phases = [(record["phase"], record.get("command")) for record in report["phases"]]
+    assert ("init_parser", "mycommand") in phases
+    assert ("parse", None) in phases
+    assert ("prepare_wrappers", None) in phases
+    assert ("command", "mycommand") in phases
+    wrappers = [r for r in report["phases"] if r["phase"] == "wrapper"]
+    assert [r["wrapper"] for r in wrappers] == ["my_wrapper", "my_wrapper"]
+    assert all(record["duration"] >= 0 for record in report["phases"])
+    assert report["summary"]["command"] <= report["total"]
+    assert report["memory_peak"] > 0
+    assert report["cprofile"] == str(cprofile)
+    assert cprofile.exists()
+
+
+def test_profile_from_environment_includes_inspect(tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text(
+        "from minicli import cli, run\n\n"
+        "@cli\n"
+        "def mycommand(param):\n"
+        "    print('Param is', param)\n\n"
+        "run()\n"
+    )
+    result = subprocess.run(
+        [sys.executable, str(script), "mycommand", "foo"],
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, MINICLI_PROFILE="-"),
+    )
+    assert "Param is foo" in result.stdout
+    report = json.loads(result.stderr)
+    assert {"inspect", "parse_shared", "command"} <= set(report["summary"])
+
+
+def test_profile_is_disabled_by_default(capsys):
+    @cli
+    def mycommand():
+        pass
+
+    run("mycommand")
+    out, err = capsys.readouterr()
+    assert not err
+
+
+def test_binding_plans_are_compiled_once(capsys, monkeypatch):
+    @cli
+    def mycommand(param, *params, option=None):
+        print(param, params, option)
+
+    @wrap
+    def my_wrapper(host, verbose=False):
+        print("before", host, verbose)
+        yield
+
+    assert mycommand._cli.plan == (
+        ("param", minicli.ARG),
+        ("params", minicli.VARARGS),
+        ("option", minicli.KWARG),
+    )
+
+    def signature(*args, **kwargs):
+        raise AssertionError("Signature inspected at run time")
+
+    monkeypatch.setattr(minicli.inspect, "signature", signature)
+    run("mycommand", "foo", "bar", "baz", "--option", "qux", host="example.org")
+    out, err = capsys.readouterr()
+    assert "before example.org None" in out
+    assert "foo ('bar', 'baz') qux" in out
+
+
+def test_docstring_is_parsed_once(capsys):
+    @cli
+    def mycommand(myparam: int, other=None):
+        """This is command doc
+        on two lines.
+
+        :myparam: this is my param help,
+                  which continues here
+        :other: this is other help
+
+        More details.
+        """
+
+    docstring = mycommand._cli.docstring
+    assert docstring.summary == "This is command doc\non two lines."
+    assert docstring.params == {
+        "myparam": "this is my param help, which continues here",
+        "other": "this is other help",
+    }
+    assert mycommand._cli.docstring is docstring
+
+    with pytest.raises(SystemExit):
+        run("mycommand", "--help")
+    out, err = capsys.readouterr()
+    assert "this is my param help, which continues here" in out
+
+
+def test_long_chains_are_split_in_one_pass(capsys, monkeypatch):
+    @cli
+    def mycommand(param, count=1, optional=False):
+        print("Param is", param, count, optional)
+
+    @cli
+    def my_other_command(*params):
+        print("Other params are", params)
+
+    calls = []
+    parse_known_args = Parser.parse_known_args
+
+    def spy(self, args=None, namespace=None):
+        calls.append(len(args))
+        return parse_known_args(self, args, namespace)
+
+    monkeypatch.setattr(Parser, "parse_known_args", spy)
+    chain = ["mycommand", "foo", "--count", "2", "mycommand", "bar", "--optional"]
+    run(*chain * 500, "my_other_command", "mycommand", "baz")
+    out, err = capsys.readouterr()
+    # Like argparse, the first mycommand takes the options of the others.
+    assert out.count("Param is foo 2 True") == 1
+    assert out.count("Param is foo 1 False") == 499
+    assert out.count("Param is bar 1 False") == 500
+    assert "Other params are ('mycommand', 'baz')" in out
+    # No global parameters to parse, and each command parser only parsed its
+    # own args, the options of the first mycommand were not parsed again.
+    assert max(calls) == 3
+
+
+def test_chains_sharing_options_are_parsed_in_linear_time(capsys):
+    app = App()
+
+    @app.cli
+    def mycommand(param, y: int = 0, flag=False):
+        pass
+
+    def duration(length):
+        chain = ["mycommand", "x", "--y", "1", "--flag"] * length
+        timings = []
+        for _ in range(3):
+            start = time.perf_counter()
+            app.run(*chain)
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    duration(10)  # Warm up.
+    # Quadratic parsing would take about 16 times longer.
+    assert duration(2000) < duration(500) * 8
+
+
+@pytest.mark.parametrize("engine", ["argparse", "fast", "check"])
+def test_chained_options_bind_like_argparse(capsys, engine):
+    @cli
+    def mycommand(param, y: int = 0, tags=[]):
+        print("Param is", param, y, tags)
+
+    @cli
+    def other(p1: int = 0, p10: int = 0, yy: int = 0):
+        print("Other", p1, p10, yy)
+
+    configure(parser=engine)
+    run("mycommand", "X", "--tags", "t", "mycommand", "Y", "--y", "3")
+    run("mycommand", "X", "--ta", "t", "mycommand", "Y", "--y", "3")
+    out, err = capsys.readouterr()
+    assert out.count("Param is X 3 ['t']") == 2
+    assert out.count("Param is Y 0 []") == 2
+
+    # Exact flag, also an abbreviation of another one.
+    run("other", "--p1", "1", "other", "--p10", "2", "--p1", "3")
+    # Abbreviation of an option of a command before the one having the flag.
+    run("other", "mycommand", "Z", "--y", "4")
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        "Other 3 2 0",
+        "Other 0 0 0",
+        "Other 0 0 4",
+        "Param is Z 0 []",
+    ]
+
+
+def test_chain_errors_are_reported_as_before(capsys):
+    @cli
+    def mycommand(param, count=1):
+        print("Param is", param)
+
+    @cli
+    def myothercommand(param):
+        print("Other param is", param)
+
+    with pytest.raises(SystemExit):
+        run("mycommand", "foo", "--count", "notanint", "myothercommand", "bar")
+    out, err = capsys.readouterr()
+    assert not out
+    assert "argument --count/-c: invalid int value: 'notanint'" in err
+
+    with pytest.raises(SystemExit):
+        run("mycommand", "foo", "myothercommand")
+    out, err = capsys.readouterr()
+    assert not out
+    assert "the following arguments are required: param" in err
+
+    # Abbreviated option: argparse parses the whole chain.
+    run("mycommand", "foo", "--cou", "2", "myothercommand", "bar")
+    out, err = capsys.readouterr()
+    assert "Param is foo" in out
+    assert "Other param is bar" in out
+
+
+def test_fast_parser_skips_argparse(capsys):
+    @cli
+    def mycommand(param, count: int = 1, optional=False, items=[]):
+        print("Param is", param, count, optional, items)
+
+    @cli
+    def my_other_command(*params, factor: float = 1):
+        print("Other params are", params, factor)
+
+    configure(parser="fast")
+    run("mycommand", "foo", "-c", "2", "--items", "a", "--items=b", "--optional")
+    run("mycommand", "foo", "my-other-command", "1", "2", "--factor", "0.5")
+    out, err = capsys.readouterr()
+    assert "Param is foo 2 True ['a', 'b']" in out
+    assert "Param is foo 1 False []" in out
+    assert "Other params are ('1', '2') 0.5" in out
+    assert not hasattr(mycommand._cli, "parser")
+    assert not hasattr(my_other_command._cli, "parser")
+
+
+def test_fast_parser_falls_back_to_argparse(capsys):
+    @cli
+    def mycommand(param, count: int = 1):
+        print("Param is", param, count)
+
+    @cli("pair", nargs=2)
+    def myothercommand(pair=None):
+        print("Pair is", pair)
+
+    configure(parser="fast")
+    with pytest.raises(SystemExit):
+        run("mycommand", "--help")
+    out, err = capsys.readouterr()
+    assert "usage:" in out and "--count" in out
+
+    with pytest.raises(SystemExit):
+        run("mycommand", "foo", "--count", "notanint")
+    out, err = capsys.readouterr()
+    assert "argument --count/-c: invalid int value: 'notanint'" in err
+
+    # Abbreviation and negative number.
+    run("mycommand", "-1", "--cou", "2")
+    # Override not handled by the fast parser.
+    run("myothercommand", "--pair", "a", "b")
+    out, err = capsys.readouterr()
+    assert "Param is -1 2" in out
+    assert "Pair is ['a', 'b']" in out
+    assert myothercommand._cli.table is None
+
+
+def test_check_parser_compares_both_engines(capsys, monkeypatch):
+    @cli("kind", choices=["a", "b"])
+    def mycommand(kind, count: int = 1, optional=False, items=[]):
+        print("Kind is", kind, count, optional, items)
+
+    configure(parser="check")
+    run("mycommand", "a", "--items", "x", "-o", "--count=3", "mycommand", "b")
+    out, err = capsys.readouterr()
+    assert "Kind is a 3 True ['x']" in out
+    assert "Kind is b 1 False []" in out
+
+    monkeypatch.setattr(minicli, "convert", lambda value, type_, choices: "c")
+    with pytest.raises(AssertionError) as e:
+        run("mycommand", "a", "--count", "3")
+    assert "Fast parser mismatch" in str(e.value)
+
+
+IMPORT_BUDGET = 0.03  # Seconds, with bytecode cached.
+
+
+def test_import_is_cheap(tmp_path):
+    env = {**os.environ, "PYTHONPYCACHEPREFIX": str(tmp_path)}
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    code = (
+        "import sys\n"
+        "from minicli import cli, run\n"
+        "@cli\n"
+        "def mycommand(param, count=1): print('Param is', param, count)\n"
+        "@cli\n"
+        "async def myasynccommand(): pass\n"
+        "run('mycommand', 'foo', '--count', '2')\n"
+        "heavy = ['asyncio', 'concurrent.futures', 'json', 'socket', 'typing']\n"
+        "print(*[name for name in heavy if name in sys.modules])\n"
+    )
+    subprocess.run([sys.executable, "-c", code], env=env, check=True)  # Cache.
+    timings = []
+    for _ in range(3):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        assert result.stdout.splitlines() == ["Param is foo 2", ""]
+        line = next(l for l in result.stderr.splitlines() if l.endswith("| minicli"))
+        timings.append(int(line.split("|")[1]) / 1e6)
+    assert min(timings) < IMPORT_BUDGET
+
+    # Neither the fast engine nor the help stored in a manifest need argparse.
+    (tmp_path / "lazycommands.py").write_text(
+        "def deploy(target, retries: int = 3):\n"
+        "    print('Deploying to', target, retries)\n"
+    )
+    code = (
+        "import sys\n"
+        "from minicli import configure, lazy, run\n"
+        "configure(manifest='manifest.json', parser='fast')\n"
+        "lazy('lazycommands:deploy', help='Deploy')\n"
+        "try:\n"
+        "    run(*sys.argv[1:])\n"
+        "finally:\n"
+        "    print('argparse' in sys.modules, file=sys.stderr)\n"
+    )
+    env["PYTHONPATH"] = os.pathsep.join([str(tmp_path), *sys.path])
+
+    def imports_argparse(*args):
+        result = subprocess.run(
+            [sys.executable, "-c", code, *args],
+            cwd=tmp_path,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return result.stderr.splitlines()[-1] == "True"
+
+    assert not imports_argparse("deploy", "prod", "--retries", "2")
+    for help in (["--help"], ["deploy", "--help"]):
+        assert imports_argparse(*help)  # Rendered and stored once.
+        assert not imports_argparse(*help)
+
+
+def test_help_is_rendered_once(capsys, monkeypatch):
+    @cli
+    def mycommand(param, count: int = 1):
+        """Do something.
+
+        :param: my param help
+        """
+
+    init_parser = minicli.Cli.init_parser
+    calls = []
+
+    def spy(self, *args, **kwargs):
+        calls.append(self.__name__)
+        return init_parser(self, *args, **kwargs)
+
+    monkeypatch.setattr(minicli.Cli, "init_parser", spy)
+    outputs = []
+    for argv in [["--help"], ["mycommand", "-h"]] * 2:
+        with pytest.raises(SystemExit) as e:
+            run(*argv)
+        assert e.value.code == 0
+        outputs.append(capsys.readouterr().out)
+    assert "Do something." in outputs[0]
+    assert "my param help" in outputs[1]
+    assert outputs[:2] == outputs[2:]
+    # Listed for the first help, its arguments added for the second one.
+    assert calls == ["mycommand"]
+
+    @cli
+    def myothercommand():
+        """Do something else."""
+
+    with pytest.raises(SystemExit):
+        run("--help")
+    out, err = capsys.readouterr()
+    assert "Do something else." in out
+
+    cli("count", help="how many times")(mycommand)
+    with pytest.raises(SystemExit):
+        run("mycommand", "-h")
+    out, err = capsys.readouterr()
+    assert "how many times" in out
+
+
+def test_help_is_stored_in_manifest(capsys, commands_module, tmp_path, monkeypatch):
+    name = commands_module(
+        "lazycommands",
+        "def deploy(target):\n"
+        '    """Deploy.\\n\\n    :target: where to deploy\\n    """\n',
+    )
+    manifest = tmp_path / "manifest.json"
+    configure(manifest=str(manifest))
+    lazy("lazycommands:deploy", help="Deploy")
+    for argv in (["--help"], ["deploy", "--help"]):
+        with pytest.raises(SystemExit):
+            run(*argv)
+    expected = capsys.readouterr().out
+    assert "where to deploy" in manifest.read_text()
+
+    # New process.
+    _registry.clear()
+    minicli._help.clear()
+    del sys.modules[name]
+    lazy("lazycommands:deploy", help="Deploy")
+    monkeypatch.setattr(minicli.Cli, "init_parser", None)
+    for argv in (["--help"], ["deploy", "--help"]):
+        with pytest.raises(SystemExit):
+            run(*argv)
+    assert capsys.readouterr().out == expected
+    assert name not in sys.modules
+
+
+def test_generator_commands_are_streamed(capsys):
+    @cli
+    def numbers(count: int = 3):
+        for index in range(count):
+            yield index
+
+    @cli
+    async def rows():
+        yield {"id": 1, "name": "a,b"}
+        yield {"id": 2, "name": None}
+
+    run("numbers", "rows")
+    out, err = capsys.readouterr()
+    assert out == "0\n1\n2\n{'id': 1, 'name': 'a,b'}\n{'id': 2, 'name': None}\n"
+
+    run("--minicli-format", "jsonl", "rows")
+    out, err = capsys.readouterr()
+    assert out == '{"id": 1, "name": "a,b"}\n{"id": 2, "name": null}\n'
+
+    run("--minicli-format", "csv", "rows", "numbers")
+    out, err = capsys.readouterr()
+    assert out == 'id,name\n1,"a,b"\n2,\n0\n1\n2\n'
+
+    configure(format="nul")
+    run("numbers")
+    out, err = capsys.readouterr()
+    assert out == "0\x001\x002\x00"
+
+
+def test_streamed_output_is_buffered(capsys, monkeypatch):
+    @cli
+    def numbers(count: int = 3):
+        yield from range(count)
+
+    writes = []
+    write = minicli.Output.flush
+
+    def spy(self):
+        writes.append(self.length)
+        write(self)
+
+    monkeypatch.setattr(minicli.Output, "flush", spy)
+    run("numbers", "--count", "100000")
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [str(index) for index in range(100000)]
+    assert len(writes) < 15
+
+
+def test_closed_stdout_stops_the_generator(tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text(
+        "import sys\n"
+        "from minicli import cli, run\n\n"
+        "@cli\n"
+        "def numbers():\n"
+        "    try:\n"
+        "        index = 0\n"
+        "        while True:\n"
+        "            yield index\n"
+        "            index += 1\n"
+        "    finally:\n"
+        "        print('Stopped', file=sys.stderr)\n\n"
+        "run()\n"
+    )
+    result = subprocess.run(
+        f"{sys.executable} {script} numbers | head -n 2",
+        shell=True,
+        capture_output=True,
+        text=True,
+        timeout=30,
+    )
+    assert result.stdout == "0\n1\n"
+    assert result.stderr == "Stopped\n"
+
+
+def test_fanout_runs_values_in_worker_processes(
+    capsys, commands_module, tmp_path, monkeypatch
+):
+    log = tmp_path / "log"
+    name = commands_module(
+        "fanoutcommands",
+        "import os\n"
+        "from minicli import cli, wrap\n\n"
+        "@cli('path', fanout='process')\n"
+        "def process(path, scale: int = 1):\n"
+        "    if path == 'bad':\n"
+        "        raise ValueError('bad path')\n"
+        "    return f'{path}:{len(path) * scale}'\n\n"
+        "@wrap\n"
+        "def setup():\n"
+        f"    with open({str(log)!r}, 'a') as f:\n"
+        "        f.write(f'setup {os.getpid()}\\n')\n"
+        "    yield\n"
+        f"    with open({str(log)!r}, 'a') as f:\n"
+        "        f.write(f'teardown {os.getpid()}\\n')\n",
+    )
+    importlib.import_module(name)
+    values = tmp_path / "values"
+    values.write_text("bb\n\nccc\n")
+    monkeypatch.setattr(sys, "stdin", io.StringIO("dddd\n"))
+    with pytest.raises(SystemExit) as e:
+        run(
+            "--minicli-jobs",
+            "2",
+            "process",
+            "a",
+            f"@{values}",
+            "bad",
+            "-",
+            "--scale",
+            "2",
+        )
+    assert e.value.code == 1
+    out, err = capsys.readouterr()
+    assert out == "a:2\nbb:4\nccc:6\ndddd:8\n"
+    assert "Item bad failed" in err
+    assert "ValueError: bad path" in err
+    assert "1 of 5 items failed" in err
+    lines = log.read_text().splitlines()
+    workers = {line.split()[1] for line in lines} - {str(os.getpid())}
+    assert 1 <= len(workers) <= 2
+    for pid in workers:
+        assert lines.count(f"setup {pid}") == lines.count(f"teardown {pid}") == 1
+
+
+def test_fanout_in_threads(capsys):
+    @cli("number", fanout="thread")
+    def square(number: int):
+        time.sleep(0.05 * (3 - number))
+        yield number * number
+
+    @cli("number", fanout="thread")
+    async def cube(number: int):
+        await asyncio.sleep(0.01 * (3 - number))
+        if number == 2:
+            sys.exit("two is not allowed")
+        return number**3
+
+    run("--minicli-jobs", "3", "square", "0", "1", "2")
+    out, err = capsys.readouterr()
+    assert out == "0\n1\n4\n"
+
+    run("--minicli-jobs", "3", "--minicli-unordered", "square", "0", "1", "2")
+    out, err = capsys.readouterr()
+    assert out == "4\n1\n0\n"
+
+    with pytest.raises(SystemExit) as e:
+        run("--minicli-format", "jsonl", "cube", "0", "1", "2")
+    assert e.value.code == 1
+    out, err = capsys.readouterr()
+    assert out == "0\n1\n"
+    assert "Item 2 failed\ntwo is not allowed\n" in err
+
+
+def test_fanout_missing_file_is_an_argument_error(capsys, tmp_path):
+    @cli("number", fanout="thread")
+    def square(number: int):
+        return number * number
+
+    missing = tmp_path / "missing.txt"
+    with pytest.raises(SystemExit) as e:
+        run("square", "1", f"@{missing}")
+    assert e.value.code == 2
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert f"argument number: can't open '{missing}'" in err
+
+
+def test_fanout_must_be_a_known_pool():
+    with pytest.raises(ValueError):
+
+        @cli("number", fanout="cluster")
+        def square(number):
+            pass
+
+
+def test_apps_are_isolated(capsys):
+    first = App()
+    second = App(format="jsonl")
+
+    @first.cli
+    def mycommand(param):
+        yield f"first {param}"
+
+    @second.cli(name="mycommand")
+    def other(param):
+        yield f"second {param}"
+
+    @first.wrap
+    def my_wrapper():
+        print("before")
+        yield
+        print("after")
+
+    first.run("mycommand", "foo")
+    second.run("mycommand", "bar")
+    out, err = capsys.readouterr()
+    assert out == "before\nfirst foo\nafter\n" + '"second bar"\n'
+    assert not _registry
+    assert [cmd.__name__ for cmd in first.registry] == ["mycommand"]
+    assert [cmd.__name__ for cmd in second.registry] == ["other"]
+
+
+def test_app_parsers_are_built_once(capsys):
+    app = App()
+
+    @app.cli
+    def mycommand(param, count: int = 1):
+        print("Param is", param, count)
+
+    app.run("mycommand", "foo")
+    parser = mycommand._cli.parser
+    app.run("mycommand", "bar", "--count", "2")
+    assert mycommand._cli.parser is parser
+    out, err = capsys.readouterr()
+    assert out == "Param is foo 1\nParam is bar 2\n"
+
+    app.cli("count", type=str)(mycommand)
+    app.run("mycommand", "baz", "--count", "3")
+    assert mycommand._cli.parser is not parser
+    out, err = capsys.readouterr()
+    assert out == "Param is baz 3\n"
+
+
+def test_app_run_is_thread_safe(capsys):
+    app = App()
+    barrier = threading.Barrier(8, timeout=5)
+    results = []
+
+    @app.cli
+    async def mycommand(number: int):
+        barrier.wait()  # All the runs are in progress, each in its own loop.
+        await asyncio.sleep(0)
+        results.append(number)
+
+    @app.wrap
+    def my_wrapper():
+        yield
+        results.append(None)
+
+    threads = [
+        threading.Thread(target=app.run, args=("mycommand", str(number)))
+        for number in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(number for number in results if number is not None) == list(range(8))
+    assert results.count(None) == 8
+
+
+def test_app_run_is_reentrant(capsys):
+    outer = App()
+    inner = App()
+
+    @inner.cli
+    def greet(name):
+        yield f"Hello {name}"
+
+    @outer.cli
+    def mycommand(name):
+        inner.run("greet", name)
+        inner.run("greet", name.upper())
+
+    outer.run("--minicli-format", "jsonl", "mycommand", "foo")
+    out, err = capsys.readouterr()
+    assert out == "Hello foo\nHello FOO\n"
+
+
+def test_repeated_runs_do_not_leak(capsys):
+    import tracemalloc
+
+    app = App()
+
+    @app.cli
+    def mycommand(param, count: int = 1):
+        pass
+
+    @app.wrap
+    def my_wrapper():
+        yield
+
+    def run_many(number):
+        for _ in range(number):
+            app.run("mycommand", "foo", "--count", "2")
+
+    run_many(200)  # Warm up: parsers, caches…
+    tracemalloc.start()
+    try:
+        run_many(200)
+        before = tracemalloc.get_traced_memory()[0]
+        run_many(2000)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert after - before < 20_000
+
+
+def test_wrappers_yield_resources_to_commands(capsys):
+    opened = []
+
+    @wrap(provides="connection")
+    def connect(dbname):
+        opened.append(dbname)
+        yield f"connection to {dbname}"
+        print("closed")
+
+    @wrap(provides="session")
+    async def login():
+        yield {"token": "secret"}
+
+    @cli
+    def mycommand(param, connection):
+        print(param, "with", connection)
+
+    @cli
+    async def myothercommand(session, connection, count=1):
+        print(session["token"], count, "with", connection)
+
+    run("mycommand", "foo", "myothercommand", "--count", "2", dbname="mydb")
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        "foo with connection to mydb",
+        "secret 2 with connection to mydb",
+        "closed",
+    ]
+    assert opened == ["mydb"]
+
+    with pytest.raises(SystemExit) as e:
+        run("mycommand", "foo", "--connection", "other", dbname="mydb")
+    assert e.value.code == 2  # Not a command line argument.
+    assert opened == ["mydb"]
+
+    with pytest.raises(SystemExit):
+        run("mycommand", "--help", dbname="mydb")
+    out, err = capsys.readouterr()
+    assert "connection" not in out
+
+
+def test_wrappers_only_provide_values_when_asked(capsys):
+    @wrap
+    def verbose():
+        yield "not for the commands"
+
+    @cli
+    def build(verbose=False):
+        print("Verbose is", verbose)
+
+    run("build", "--verbose")
+    out, err = capsys.readouterr()
+    assert out == "Verbose is True\n"
+
+
+def test_fanout_threads_share_the_resources(capsys):
+    @wrap(provides="offset")
+    def offset():
+        yield 10
+
+    @cli("number", fanout="thread")
+    def add(number: int, offset):
+        return number + offset
+
+    run("--minicli-jobs", "2", "add", "1", "2")
+    out, err = capsys.readouterr()
+    assert out == "11\n12\n"
+
+
+def test_cached_command_output_is_replayed(capsys, tmp_path):
+    configure(cache_dir=str(tmp_path / "cache"))
+    calls = []
+
+    @cli(cache=True)
+    def report(source: Path, title="Report"):
+        calls.append(source)
+        print(title, source.read_text())
+        yield "done"
+
+    source = tmp_path / "source.txt"
+    source.write_text("v1")
+    for _ in range(2):
+        run("report", str(source))
+        out, err = capsys.readouterr()
+        assert out == "Report v1\ndone\n"
+    assert len(calls) == 1
+
+    run("report", str(source), "--title", "Other")
+    source.write_text("v2")
+    run("report", str(source))
+    out, err = capsys.readouterr()
+    assert out == "Other v1\ndone\nReport v2\ndone\n"
+    assert len(calls) == 3
+
+    run("--minicli-no-cache", "report", str(source))
+    out, err = capsys.readouterr()
+    assert out == "Report v2\ndone\n"
+    assert len(calls) == 4
+
+
+def test_cached_commands_run_again_once_their_code_changed(capsys, tmp_path):
+    calls = []
+    script = tmp_path / "script.py"
+    for version in ("v1", "v1", "v22"):
+        code = f"def report():\n    calls.append(1)\n    print({version!r})\n"
+        if not script.exists() or script.read_text() != code:
+            script.write_text(code)
+        namespace = {"__name__": "script", "calls": calls}
+        exec(compile(script.read_text(), str(script), "exec"), namespace)
+        app = App(cache_dir=str(tmp_path / "cache"))
+        app.cli(cache=True)(namespace["report"])
+        app.run("report")
+    out, err = capsys.readouterr()
+    assert out == "v1\nv1\nv22\n"
+    assert len(calls) == 2
+
+
+def test_cached_streamed_arguments_are_read_again(capsys, tmp_path, monkeypatch):
+    configure(cache_dir=str(tmp_path / "cache"))
+    ids = tmp_path / "ids.txt"
+    calls = []
+
+    @cli(cache=True)
+    @cli("ids", stream=True)
+    def total(ids: int):
+        calls.append(1)
+        print(sum(ids))
+
+    for numbers in ("1\n2\n", "1\n2\n", "1\n2\n30\n"):
+        if not ids.exists() or ids.read_text() != numbers:
+            ids.write_text(numbers)
+        run("total", f"@{ids}")
+    assert len(calls) == 2
+    for numbers in ("4\n", "5\n"):
+        monkeypatch.setattr(sys, "stdin", io.StringIO(numbers))
+        run("total", "-")
+    out, err = capsys.readouterr()
+    assert out == "3\n3\n33\n4\n5\n"
+    assert len(calls) == 4
+
+
+def test_cached_exit_status_is_replayed(capsys, tmp_path):
+    configure(cache_dir=str(tmp_path))
+    calls = []
+
+    @cli(cache=60)
+    def check(name):
+        calls.append(name)
+        print("checking", name)
+        sys.exit(3)
+
+    for _ in range(2):
+        with pytest.raises(SystemExit) as e:
+            run("check", "foo")
+        assert e.value.code == 3
+        out, err = capsys.readouterr()
+        assert out == "checking foo\n"
+    assert calls == ["foo"]
+
+    (entry,) = tmp_path.iterdir()
+    data = json.loads(entry.read_text())
+    data["expires"] = time.time() - 1
+    entry.write_text(json.dumps(data))
+    with pytest.raises(SystemExit):
+        run("check", "foo")
+    assert calls == ["foo", "foo"]
+
+
+def test_scheduled_cached_commands_are_replayed(capsys, tmp_path):
+    configure(cache_dir=str(tmp_path))
+    calls = []
+
+    @cli
+    def prep():
+        calls.append("prep")
+        print("prepared")
+
+    @cli(cache=True, requires=["prep"])
+    def report(title="Report"):
+        calls.append("report")
+        print(title)
+        yield "done"
+
+    @cli(requires=["prep"])
+    def other():
+        for index in range(100):
+            print("other", index)
+
+    for _ in range(2):
+        run("report", "other")
+        out, err = capsys.readouterr()
+        assert out.startswith("prepared\n")
+        assert out.count("Report") == out.count("done") == 1
+        assert out.count("other") == 100
+    assert calls == ["prep", "report", "prep"]
+    # What the concurrent command printed was not stored.
+    (entry,) = tmp_path.iterdir()
+    assert json.loads(entry.read_text())["output"] == "Report\ndone\n"
+
+
+def test_cache_evicts_least_recently_used(capsys, tmp_path):
+    configure(cache_dir=str(tmp_path), cache_size=150)  # Two entries.
+    calls = []
+
+    @cli(cache=True)
+    def echo(text):
+        calls.append(text)
+        print(text * 20)
+
+    for text in "abac":
+        run("echo", text)
+        time.sleep(0.01)  # Distinct mtimes.
+    assert len(list(tmp_path.iterdir())) == 2
+    run("echo", "a")  # Used after "b", which was evicted.
+    run("echo", "b")
+    assert calls == ["a", "b", "c", "b"]
+
+
+def test_cache_must_be_a_time_to_live():
+    with pytest.raises(ValueError):
+
+        @cli(cache="forever")
+        def mycommand():
+            pass
+
+
+def test_required_commands_are_run_first(capsys):
+    calls = []
+
+    @cli(requires=["compile"])
+    def build(target="all"):
+        calls.append(f"build {target}")
+
+    @cli(requires=["fetch"])
+    def compile():
+        calls.append("compile")
+
+    @cli
+    async def fetch(url="default"):
+        calls.append(f"fetch {url}")
+
+    run("build", "--target", "docs")
+    assert calls == ["fetch default", "compile", "build docs"]
+    calls.clear()
+    run("build", "fetch", "--url", "other")
+    assert calls == ["fetch other", "compile", "build all"]
+
+
+def test_independent_requirements_run_concurrently(capsys):
+    barrier = threading.Barrier(2, timeout=5)
+
+    @cli
+    def first():
+        barrier.wait()  # Would time out if run one after the other.
+
+    @cli
+    def second():
+        barrier.wait()
+
+    @cli(requires=["first", "second"])
+    def last():
+        print("last")
+
+    run("--minicli-jobs", "2", "last")
+    out, err = capsys.readouterr()
+    assert out == "last\n"
+
+
+def test_up_to_date_commands_are_skipped(capsys, tmp_path):
+    calls = []
+    source = tmp_path / "page.md"
+    source.write_text("# Title")
+
+    @cli(inputs=[str(tmp_path / "{name}.md")], outputs=[str(tmp_path / "{name}.html")])
+    def render(name):
+        calls.append(name)
+        (tmp_path / f"{name}.html").write_text("<h1>Title</h1>")
+
+    run("render", "page")
+    run("render", "page")
+    out, err = capsys.readouterr()
+    assert "Command render is up to date" in err
+    assert calls == ["page"]
+    os.utime(source, ns=(time.time_ns() + 10**9,) * 2)
+    run("render", "page")
+    assert calls == ["page", "page"]
+
+
+def test_unrelated_commands_keep_their_order(capsys, tmp_path):
+    target = tmp_path / "out.txt"
+    target.write_text("old")
+
+    @cli
+    def clean():
+        target.unlink()
+
+    @cli(outputs=[str(target)])
+    def build():
+        target.write_text("new")
+
+    run("clean", "build")
+    out, err = capsys.readouterr()
+    assert "up to date" not in err
+    assert target.read_text() == "new"
+
+
+def test_failed_requirements_stop_their_dependents(capsys):
+    calls = []
+
+    @cli
+    def broken():
+        raise ValueError("broken")
+
+    @cli(requires=["broken"])
+    def dependent():
+        calls.append("dependent")
+
+    @cli(requires=["independent"])
+    def other():
+        calls.append("other")
+
+    @cli
+    def independent():
+        calls.append("independent")
+
+    with pytest.raises(SystemExit) as e:
+        run("dependent", "other")
+    assert e.value.code == 1
+    assert calls == ["independent", "other"]
+    out, err = capsys.readouterr()
+    assert "Command broken failed" in err
+    assert "Command dependent not run" in err
+
+
+def test_requirements_are_checked_before_running(capsys):
+    calls = []
+
+    @cli(requires=["second"])
+    def first():
+        calls.append("first")
+
+    @cli(requires=["first"])
+    def second():
+        calls.append("second")
+
+    @cli(requires=["missing"])
+    def third():
+        calls.append("third")
+
+    @cli(requires=["needs-arg"])
+    def fourth():
+        calls.append("fourth")
+
+    @cli
+    def needs_arg(param):
+        calls.append("needs_arg")
+
+    for name, error in [
+        ("first", "circular requirements: "),
+        ("third", "third requires an unknown command: missing"),
+        ("fourth", "the following arguments are required: param"),
+    ]:
+        with pytest.raises(SystemExit) as e:
+            run(name)
+        assert e.value.code == 2
+        out, err = capsys.readouterr()
+        assert error in err
+    assert not calls
+
+
+def test_streamed_arguments_are_read_lazily(capsys, tmp_path, monkeypatch):
+    ids = tmp_path / "ids.txt"
+    ids.write_text("".join(f"{number}\n" for number in range(100_000)))
+    monkeypatch.setattr(sys, "stdin", io.StringIO("7\n8\n"))
+    received = []
+
+    @cli("ids", stream=True)
+    def delete(ids: int, dry_run=False):
+        assert not isinstance(ids, (list, tuple))
+        received.append(sum(ids))
+
+    @cli("tags", stream=True)
+    def tag(*tags):
+        received.append(tags)
+
+    @cli("names", stream=True)
+    def rename(names=[]):
+        received.append(list(names))
+
+    run("delete", "1", f"@{ids}", "-")
+    assert received.pop() == 1 + sum(range(100_000)) + 7 + 8
+    run("tag", "a", f"@{ids}")
+    assert received.pop()[:3] == ("a", "0", "1")
+    run("rename", "--names", "a", "--names", f"@{ids}")
+    assert received.pop()[:3] == ["a", "0", "1"]
+    run("rename")
+    assert received.pop() == []
+
+    with pytest.raises(SystemExit) as e:
+        run("delete", "1", "two")
+    assert e.value.code == "invalid int value: 'two'"
+
+
+def test_streamed_missing_file_is_a_parse_error(capsys, tmp_path):
+    calls = []
+
+    @cli
+    def first():
+        calls.append("first")
+
+    @cli("ids", stream=True)
+    def delete(ids: int):
+        calls.append(list(ids))
+
+    missing = tmp_path / "missing.txt"
+    for engine in ("argparse", "fast"):
+        configure(parser=engine)
+        with pytest.raises(SystemExit) as e:
+            run("first", "delete", "1", f"@{missing}")
+        assert e.value.code == 2
+        out, err = capsys.readouterr()
+        assert f"argument ids: can't open '{missing}'" in err
+    assert calls == []
+
+
+@pytest.mark.parametrize("engine", ["argparse", "fast", "check"])
+def test_streamed_options_keep_a_none_default(capsys, engine):
+    configure(parser=engine)
+    received = []
+
+    @cli("ids", stream=True)
+    def delete(ids: List[int] = None):
+        received.append(ids if ids is None else list(ids))
+
+    run("delete")
+    run("delete", "--ids", "1", "--ids", "2")
+    assert received == [None, [1, 2]]
+
+
+def test_numeric_lists_are_arrays(capsys):
+    import array
+
+    received = []
+
+    @cli
+    def stats(values: List[float], weights: List[int] = [], scale: array.array = []):
+        received.append((values, weights, scale))
+
+    run("stats", "1.5", "2", "-1000.5", "--weights", "1", "2", "--weights", "3")
+    values, weights, scale = received.pop()
+    assert values == array.array("d", [1.5, 2, -1000.5])
+    assert weights == array.array("q", [1, 2, 3])
+    assert scale == array.array("d") and isinstance(scale, array.array)
+
+    run("stats", "1", "--scale", "0.5")
+    values, weights, scale = received.pop()
+    assert weights == array.array("q") and scale == array.array("d", [0.5])
+
+    for argv, error in [
+        (["stats", "1", "x"], "argument values: invalid float value: 'x' (value 2)"),
+        (["stats", "1", "--weights", "2", "2.5"], "invalid int value: '2.5' (value 2)"),
+        (["stats", "1", "--weights", str(2**64)], "out of range int value"),
+    ]:
+        with pytest.raises(SystemExit) as e:
+            run(*argv)
+        assert e.value.code == 2
+        out, err = capsys.readouterr()
+        assert error in err
+    assert not received
+
+
+def test_metrics_are_written_as_json_lines(tmp_path):
+    from minicli.metrics import JsonLinesSink, flush
+
+    path = tmp_path / "metrics.jsonl"
+    configure(metrics=JsonLinesSink(path))
+
+    @cli
+    def ok():
+        pass
+
+    @cli
+    def broken():
+        raise ValueError("oops")
+
+    @cli
+    def stopped():
+        sys.exit(3)
+
+    @wrap
+    def connection():
+        yield
+
+    run("ok")
+    for name, status in (("broken", ValueError), ("stopped", SystemExit)):
+        with pytest.raises(status):
+            run(name)
+    flush()
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    summary = [
+        (r["kind"], r["name"], r.get("phase"), r["status"], r["exception"])
+        for r in records
+    ]
+    assert summary == [
+        ("wrapper", "connection", "setup", 0, None),
+        ("command", "ok", None, 0, None),
+        ("wrapper", "connection", "teardown", 0, None),
+        ("wrapper", "connection", "setup", 0, None),
+        ("command", "broken", None, 1, "ValueError"),
+        ("wrapper", "connection", "teardown", 0, None),
+        ("wrapper", "connection", "setup", 0, None),
+        ("command", "stopped", None, 3, None),
+        ("wrapper", "connection", "teardown", 0, None),
+    ]
+    assert all(r["wall"] >= 0 and r["cpu"] >= 0 for r in records)
+    assert all(r["max_rss"] > 0 for r in records)
+
+
+def test_metrics_are_sent_to_statsd():
+    import socket
+
+    from minicli.metrics import StatsdSink, flush
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(5)
+    configure(metrics=StatsdSink(port=server.getsockname()[1], prefix="test"))
+
+    @cli
+    def broken():
+        raise ValueError("oops")
+
+    with pytest.raises(ValueError):
+        run("broken")
+    flush()
+    lines = server.recv(1500).decode().splitlines()
+    server.close()
+    names = [line.split(":")[0] for line in lines]
+    assert names == [
+        "test.command.broken.wall",
+        "test.command.broken.cpu",
+        "test.command.broken.max_rss",
+        "test.command.broken.status.1",
+        "test.command.broken.exception.ValueError",
+    ]
+    assert lines[0].endswith("|ms")
+
+
+def test_metrics_do_not_wait_for_the_sink():
+    from minicli.metrics import flush
+
+    sent = threading.Event()
+    batches = []
+
+    def sink(records):
+        sent.wait(5)
+        batches.append(records)
+
+    configure(metrics=sink, concurrency=4)
+
+    @cli
+    def mycommand():
+        pass
+
+    @cli
+    async def myasynccommand():
+        pass
+
+    run("mycommand", "myasynccommand")
+    run("mycommand")
+    assert not batches  # The sink is still blocked.
+    sent.set()
+    flush()
+    names = [record["name"] for records in batches for record in records]
+    assert sorted(names) == ["myasynccommand", "mycommand", "mycommand"]